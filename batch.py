@@ -0,0 +1,77 @@
+"""
+  Batched processing of frames across a thread pool. OpenCV releases the GIL,
+  so threads scale across cores without copying frames between processes.
+  A batch is an (N, H, W[, C]) numpy array or a list of frames of one shape;
+  results are written into a preallocated (N, ...) array. E.g.
+  out = output_buffer(None, len(frames), (h, w, 3), np.uint8)
+  map_batch(lambda frame, dst: cv2.remap(frame, m1, m2, cv2.INTER_LINEAR,
+                                         dst=dst), frames, out)
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def batch_shape(frames):
+    """
+      Shape and dtype of the frames of a batch, checked to be the same for
+      all of them.
+    """
+    if isinstance(frames, np.ndarray):
+        return frames.shape[1:], frames.dtype
+    if len(frames) == 0:
+        raise ValueError("Empty batch")
+    shape, dtype = frames[0].shape, frames[0].dtype
+    for frame in frames:
+        if frame.shape != shape or frame.dtype != dtype:
+            raise ValueError("Frames of a batch must share shape and dtype, "
+                             "got %s %s and %s %s" % (shape, dtype,
+                                                      frame.shape,
+                                                      frame.dtype))
+    return shape, dtype
+
+
+def output_buffer(out, count, shape, dtype):
+    """
+      out, checked to hold count results of the given shape and dtype, or a
+      new array for them if out is None.
+    """
+    shape = (count,) + tuple(shape)
+    if out is None:
+        return np.empty(shape, dtype)
+    if out.shape != shape or out.dtype != dtype:
+        raise ValueError("Output buffer is %s %s, expected %s %s"
+                         % (out.shape, out.dtype, shape, np.dtype(dtype)))
+    return out
+
+
+def map_batch(process, frames, out, workers=None, make_state=None):
+    """
+      Call process(frame, dst) for each frame and the matching slice of out,
+      returning out. Frames are split into contiguous runs, one per worker
+      thread (os.cpu_count() by default). With make_state, each run gets its
+      own state = make_state(), passed as process(frame, dst, state), for
+      scratch buffers that must not be shared between threads.
+    """
+    count = len(frames)
+    workers = max(1, min(workers or os.cpu_count() or 1, count))
+
+    def run(start, stop):
+        state = make_state() if make_state is not None else None
+        for i in range(start, stop):
+            if make_state is None:
+                process(frames[i], out[i])
+            else:
+                process(frames[i], out[i], state)
+
+    if workers == 1:
+        run(0, count)
+        return out
+    bounds = np.linspace(0, count, workers + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run, start, stop)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+    return out
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+  Benchmarks for the lane detection pipeline. Measures construction of
+  CameraCalibration and BirdsEyeTransform, and per-frame latency (with a
+  per-stage breakdown) of process_image, process_batch, LaneLines.update
+  (also coarse-to-fine) and LaneLines.find_lane_pixels over test_images,
+  video_images and synthetic frames at several resolutions. Results are
+  written as JSON and can be compared against an earlier run:
+  ./benchmark.py --output baseline.json
+  ./benchmark.py --output current.json --baseline baseline.json
+"""
+
+import argparse
+import json
+import platform
+import tempfile
+import time
+import cv2
+import numpy as np
+import instrumentation
+from instrumentation import latency_stats
+import pipeline
+from frame_store import image_store
+from camera_calibration import CameraCalibration
+from birdseye_transform import BirdsEyeTransform
+from lane_lines import LaneLines
+
+cal_glob = 'camera_cal/calibration*.jpg'
+straight_glob = 'test_images/straight_lines*jpg'
+synthetic_sizes = [(640, 360), (1280, 720), (1920, 1080)]
+
+
+def time_calls(fn, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def load_frames(image_glob):
+    # memory-mapped, decoded once per set of images
+    return image_store(image_glob, pipeline.cache_dir).frames
+
+
+def synthetic_frames(size, count=4, seed=0):
+    # real frames resized to size, plus uniform noise as a worst case for
+    # the number of thresholded pixels
+    rng = np.random.RandomState(seed)
+    frames = [cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+              for frame in load_frames('test_images/test*.jpg')[:count - 1]]
+    frames.append(rng.randint(0, 256, (size[1], size[0], 3), np.uint8))
+    return frames
+
+
+def bench_construction(repeat):
+    results = {}
+    seconds = time_calls(lambda: CameraCalibration(cal_glob), repeat)
+    results['CameraCalibration'] = latency_stats(seconds)
+    c = CameraCalibration(cal_glob)
+    seconds = time_calls(lambda: BirdsEyeTransform(c, straight_glob), repeat)
+    results['BirdsEyeTransform'] = latency_stats(seconds)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        CameraCalibration(cal_glob, cache_dir=cache_dir)
+        BirdsEyeTransform(c, straight_glob, cache_dir=cache_dir)
+
+        def cached():
+            cc = CameraCalibration(cal_glob, cache_dir=cache_dir)
+            BirdsEyeTransform(cc, straight_glob, cache_dir=cache_dir)
+        results['cached_construction'] = latency_stats(
+            time_calls(cached, repeat))
+    return results
+
+
+def bench_process_image(frames, repeat, warp_first=False):
+    """
+      Latency of process_image over repeat passes of frames, tracked as one
+      stream, with the per-stage breakdown from instrumentation.
+    """
+    ll = pipeline.new_lane_lines(warp_first)
+    pipeline.process_image(frames[0], lane_lines=ll, warp_first=warp_first)
+    ll.reset()
+    inst = instrumentation.Instrumentation()
+    with inst.active():
+        for _ in range(repeat):
+            for frame in frames:
+                with inst.frame():
+                    pipeline.process_image(frame, lane_lines=ll,
+                                           warp_first=warp_first)
+    result = latency_stats([record['total'] for record in inst.records])
+    result['fps'] = 1000 / result['mean_ms']
+    result['stages'] = inst.summary()
+    return result
+
+
+def bench_process_batch(frames, repeat, warp_first=False, workers=None):
+    """
+      Per-frame latency of process_batch over the frames as one batch.
+    """
+    batch = np.array(frames)
+    out = np.empty_like(batch)
+    pipeline.process_batch(batch, warp_first=warp_first, workers=workers,
+                           out=out)
+    result = latency_stats(time_calls(
+        lambda: pipeline.process_batch(batch, warp_first=warp_first,
+                                       workers=workers, out=out), repeat))
+    for key in list(result):
+        if key.endswith('_ms'):
+            result[key] /= len(frames)
+    result['fps'] = 1000 / result['mean_ms']
+    return result
+
+
+def bench_lane_lines(frames, repeat, coarse=1):
+    binaries = [pipeline.t.transform(pipeline.threshold.apply(
+                    pipeline.c.undistort(frame))) for frame in frames]
+    ll = LaneLines(pipeline.t.meters_per_pixel, coarse=coarse)
+    results = {}
+    if coarse == 1:
+        results['find_lane_pixels'] = latency_stats(
+            time_calls(lambda: [ll.find_lane_pixels(b) for b in binaries],
+                       repeat))
+    else:
+        results['coarse_to_fine_pixels'] = latency_stats(
+            time_calls(lambda: [ll.coarse_to_fine_pixels(b)
+                                for b in binaries], repeat))
+
+    def update_fresh():
+        for b in binaries:
+            ll.reset()
+            ll.update(b)
+    results['update_fresh'] = latency_stats(time_calls(update_fresh, repeat))
+    ll.reset()
+    results['update_tracked'] = latency_stats(
+        time_calls(lambda: [ll.update(b) for b in binaries], repeat))
+    for name in results:
+        for key in list(results[name]):
+            if key.endswith('_ms'):
+                results[name][key] /= len(binaries)
+    return results
+
+
+def run(repeat, quick=False):
+    frame_sets = {'test_images': load_frames('test_images/*.jpg'),
+                  'video_images': load_frames('video_images/*.jpg')}
+    sizes = synthetic_sizes[1:2] if quick else synthetic_sizes
+    for size in sizes:
+        frame_sets['synthetic_%dx%d' % size] = synthetic_frames(size)
+    results = {}
+    if not quick:
+        results['construction'] = bench_construction(max(1, repeat // 2))
+    for name, frames in frame_sets.items():
+        results['process_image/' + name] = bench_process_image(frames,
+                                                               repeat)
+        results['process_image_warp_first/' + name] = bench_process_image(
+            frames, repeat, warp_first=True)
+    for name in ('test_images', 'video_images'):
+        results['process_batch/' + name] = bench_process_batch(
+            frame_sets[name], repeat)
+    results['lane_lines/test_images'] = bench_lane_lines(
+        frame_sets['test_images'], repeat)
+    for coarse in (2, 4):
+        results['lane_lines_coarse%d/test_images' % coarse] = \
+            bench_lane_lines(frame_sets['test_images'], repeat, coarse)
+    return {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__, 'opencv': cv2.__version__,
+                     'machine': platform.machine(),
+                     'processor': platform.processor(),
+                     'cv2_threads': cv2.getNumThreads(),
+                     'repeat': repeat},
+            'results': results}
+
+
+def flatten(results, prefix=''):
+    """
+      Median latency of every benchmark, and of every stage of the
+      process_image benchmarks, by slash separated name.
+    """
+    flat = {}
+    for name, value in results.items():
+        if 'p50_ms' in value:
+            flat[prefix + name] = value['p50_ms']
+            for stage, stats in value.get('stages', {}).items():
+                flat[prefix + name + '/' + stage] = stats['p50']
+        else:
+            flat.update(flatten(value, prefix + name + '/'))
+    return flat
+
+
+def compare(current, baseline):
+    current = flatten(current['results'])
+    baseline = flatten(baseline['results'])
+    print('{:<60} {:>10} {:>10} {:>7}'.format('p50', 'baseline', 'current',
+                                              'ratio'))
+    for name in sorted(current):
+        if name not in baseline:
+            continue
+        before, after = baseline[name], current[name]
+        print('{:<60} {:>10.2f} {:>10.2f} {:>7.2f}'.format(
+            name, before, after, after / before if before else float('nan')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='earlier results to compare to')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true',
+                        help='skip construction and most synthetic sizes')
+    parser.add_argument('--threads', type=int,
+                        help='OpenCV threads, for reproducible runs')
+    args = parser.parse_args()
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+    results = run(args.repeat, quick=args.quick)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for name, value in sorted(flatten(results['results']).items()):
+        print('{:<60} p50 {:>10.2f}'.format(name, value))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
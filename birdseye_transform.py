@@ -1,7 +1,11 @@
+import copy
 import cv2
 import glob
 import numpy as np
+import os
 import matplotlib.image as mpimg
+import calibration_cache
+from batch import *
 from processing_helpers import *
 
 
@@ -14,24 +18,67 @@ class BirdsEyeTransform:
       transformed = t.transform(image)
       Obtain the meters-per-pixel value for transformed images:
       mpp = t.meters_per_pixel
+      With use_remap=True, warp coordinate maps are built once per image size
+      and transform/untransform are a single remap. transform_raw takes a raw
+      camera frame straight to birds' eye view, with undistortion folded into
+      the same precomputed remap table. transform_batch and
+      transform_raw_batch warp a batch of frames across a thread pool.
+      Only part of each frame is ever sampled: t.source_box(shape) bounds it,
+      and t.transform_cropped(image[y0:y1, x0:x1], shape) warps a frame
+      cropped to that box, so earlier stages need only process the crop.
+      t.scaled(0.5) gives a transform to half resolution birds' eye images.
+      t.share_maps(cache, key) keeps the remap tables in a shared
+      camera_registry.MapCache instead of the instance.
+      With cache_dir set, the inferred transform is stored there keyed by the
+      straight images, the camera calibration and the detection parameters,
+      and reused by later instances.
+      With debug_dir set, the filtered, lined and transformed straight images
+      used to infer the transform are saved there (and the cache is not read,
+      so they are always produced).
     """
     DASHED_LANE_LENGTH = 3.0  # meters
     LANE_WIDTH = 3.7  # meters
+    _OUTSIDE = -1000.0  # remap coordinate for pixels with no source
+    # pixels kept around the sampled region when cropping, for bilinear
+    # interpolation and 3x3 gradients
+    SOURCE_BORDER = 2
 
     meters_per_pixel = None
+    scale = 1.0
     _m = None
     _m_inv = None
 
-    def __init__(self, camera_calibration, straight_glob):
-        # out_dir = "intermediate/"
+    def __init__(self, camera_calibration, straight_glob, use_remap=False,
+                 cache_dir=None, debug_dir=None):
+        self.use_remap = False
+        self._camera_calibration = camera_calibration
+        self._maps = {}
+        self._boxes = {}
         rho = 6
         theta = np.pi/180
         threshold = 200
         min_line_len = 300
         max_line_gap = 120
         image_fnames = glob.glob(straight_glob)
+        if cache_dir is not None:
+            key = calibration_cache.cache_key(
+                image_fnames, camera_calibration._cal_mtx,
+                camera_calibration._cal_dist, rho, theta, threshold,
+                min_line_len, max_line_gap,
+                BirdsEyeTransform.DASHED_LANE_LENGTH,
+                BirdsEyeTransform.LANE_WIDTH)
+            cached = (calibration_cache.load(cache_dir, 'birdseye_transform',
+                                             key)
+                      if debug_dir is None else None)
+            if cached is not None:
+                self._m = cached['m']
+                self._m_inv = cached['m_inv']
+                self.meters_per_pixel = float(cached['meters_per_pixel'])
+                self.use_remap = use_remap
+                return
         left_arr, right_arr = [], []
         binary_combos = {}
+        lined_images = {}
         for fname in image_fnames:
             image = mpimg.imread(fname)
             image = camera_calibration.undistort(image)
@@ -44,22 +91,25 @@ class BirdsEyeTransform:
                                   (0.5*imshape[1], 0.59*imshape[0]),
                                   (imshape[1], imshape[0])]], dtype=np.int32)
 
-            # Visualize filtered points from undistorted image
-            # color_binary = np.dstack(( np.zeros_like(binary_sobelx),
-            #                           binary_sobelx, binary_s)) * 255
-            # color_binary = region_of_interest(color_binary, vertices)
-            # mpimg.imsave(out_dir + fname.split('/')[-1][:-4] +
-            #              "_t_filtered.jpg", color_binary)
+            if debug_dir is not None:
+                # Visualize filtered points from undistorted image
+                color_binary = np.dstack((np.zeros_like(binary_sobelx),
+                                          binary_sobelx, binary_s)) * 255
+                color_binary = region_of_interest(color_binary, vertices)
+                mpimg.imsave(_debug_name(debug_dir, fname, "_t_filtered"),
+                             color_binary)
 
             binary_combo = region_of_interest(binary_combo, vertices)
             lines = cv2.HoughLinesP(binary_combo, rho, theta, threshold,
                                     np.array([]),
                                     minLineLength=min_line_len,
                                     maxLineGap=max_line_gap)
-            # Visualize lines on undistorted image
-            # draw_lines(image, lines)
-            # mpimg.imsave(out_dir + fname.split('/')[-1][:-4] +
-            #              "_t_filtered_lined.jpg", image)
+            if debug_dir is not None:
+                # Visualize lines on undistorted image
+                draw_lines(image, lines)
+                mpimg.imsave(_debug_name(debug_dir, fname,
+                                         "_t_filtered_lined"), image)
+                lined_images[fname] = image
 
             # calculate transform
             i_left, i_right = lines_to_left_right(lines, imshape)
@@ -94,14 +144,14 @@ class BirdsEyeTransform:
                                             transformed_binary_combo,
                                             transformed_left,
                                             transformed_right))
-            # Visualize transformed straight lane image
-            # mpimg.imsave(out_dir + fname.split('/')[-1][:-4] +
-            #              "_t_filtered_transformed.jpg",
-            #              transformed_binary_combo)
-            # transformed = self.transform(image)
-            # mpimg.imsave(out_dir + fname.split('/')[-1][:-4] +
-            #              "_t_filtered_lined_transformed.jpg",
-            #              transformed)
+            if debug_dir is not None:
+                # Visualize transformed straight lane image
+                mpimg.imsave(_debug_name(debug_dir, fname,
+                                         "_t_filtered_transformed"),
+                             transformed_binary_combo, cmap='gray')
+                mpimg.imsave(_debug_name(debug_dir, fname,
+                                         "_t_filtered_lined_transformed"),
+                             self.transform(lined_images[fname]))
 
         self.meters_per_pixel = np.mean(meters_per_pixel_arr)
         x_offset = 0.5*BirdsEyeTransform.LANE_WIDTH/self.meters_per_pixel
@@ -111,17 +161,205 @@ class BirdsEyeTransform:
                           [xl, 0]])
         self._m = cv2.getPerspectiveTransform(src, dst)
         self._m_inv = cv2.getPerspectiveTransform(dst, src)
+        self.use_remap = use_remap
+        if cache_dir is not None:
+            calibration_cache.save(cache_dir, 'birdseye_transform', key,
+                                   m=self._m, m_inv=self._m_inv,
+                                   meters_per_pixel=self.meters_per_pixel)
 
-    def transform(self, image):
-        img_size = (image.shape[1], image.shape[0])
-        return cv2.warpPerspective(image, self._m, img_size,
+    def transform(self, image, dst=None):
+        out_shape = self.warped_shape(image.shape)
+        if self.use_remap:
+            map1, map2 = self.warp_maps(image.shape, inverse=False)
+            return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        img_size = (out_shape[1], out_shape[0])
+        return cv2.warpPerspective(image, self._m, img_size, dst=dst,
                                    flags=cv2.INTER_AREA)
 
-    def untransform(self, image):
-        img_size = (image.shape[1], image.shape[0])
-        return cv2.warpPerspective(image, self._m_inv, img_size,
+    def untransform(self, image, shape=None, dst=None):
+        if shape is None:
+            shape = self.unwarped_shape(image.shape)
+        if self.use_remap:
+            map1, map2 = self.warp_maps(shape, inverse=True)
+            return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        img_size = (shape[1], shape[0])
+        return cv2.warpPerspective(image, self._m_inv, img_size, dst=dst,
                                    flags=cv2.INTER_AREA)
 
+    def transform_cropped(self, image, shape, dst=None):
+        """
+          Birds' eye view of a frame of the given shape, from the frame
+          cropped to source_box(shape).
+        """
+        if self.use_remap:
+            map1, map2 = self.cropped_warp_maps(shape)
+            return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        x0, y0, _, _ = self.source_box(shape)
+        # crop to frame coordinates, then to birds' eye view
+        m = np.matmul(self._m, np.array([[1.0, 0, x0], [0, 1.0, y0],
+                                         [0, 0, 1.0]]))
+        out_shape = self.warped_shape(shape)
+        return cv2.warpPerspective(image, m, (out_shape[1], out_shape[0]),
+                                   dst=dst, flags=cv2.INTER_AREA)
+
+    def transform_raw(self, image, dst=None):
+        map1, map2 = self.raw_maps(image.shape)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    def untransform_points(self, points):
+        """
+          (x, y) points of a birds' eye image, as an (N, 2) array, mapped to
+          their positions in the (undistorted) camera frame.
+        """
+        points = np.asarray(points, np.float64).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(points, self._m_inv).reshape(-1, 2)
+
+    def transform_batch(self, frames, out=None, workers=None):
+        """
+          Birds' eye views of a batch of frames (an (N, H, W[, C]) array or a
+          list of frames of one shape) in out, allocated if not given,
+          computed across workers threads. All frames share one set of remap
+          tables, whether or not use_remap is set.
+        """
+        shape, dtype = batch_shape(frames)
+        maps = self.warp_maps(shape, inverse=False)
+        return self._remap_batch(frames, maps, shape, dtype, out, workers)
+
+    def transform_raw_batch(self, frames, out=None, workers=None):
+        """
+          As transform_batch, for raw camera frames (see transform_raw).
+        """
+        shape, dtype = batch_shape(frames)
+        maps = self.raw_maps(shape)
+        return self._remap_batch(frames, maps, shape, dtype, out, workers)
+
+    def _remap_batch(self, frames, maps, shape, dtype, out, workers):
+        map1, map2 = maps
+        out = output_buffer(out, len(frames),
+                            self.warped_shape(shape) + tuple(shape[2:]),
+                            dtype)
+        return map_batch(lambda image, dst: cv2.remap(image, map1, map2,
+                                                      cv2.INTER_LINEAR,
+                                                      dst=dst),
+                         frames, out, workers)
+
+    def scaled(self, scale):
+        """
+          Copy of this transform producing birds' eye images scaled by scale
+          (e.g. 0.5 for half width and height), with meters_per_pixel
+          adjusted to match.
+        """
+        scaled = copy.copy(self)
+        s = np.diag([scale, scale, 1.0])
+        scaled._m = np.matmul(s, self._m)
+        scaled._m_inv = np.matmul(self._m_inv, np.linalg.inv(s))
+        scaled.meters_per_pixel = self.meters_per_pixel / scale
+        scaled.scale = self.scale * scale
+        scaled._maps = {}
+        scaled._boxes = {}
+        return scaled
+
+    def share_maps(self, cache, namespace):
+        # keep remap tables in a shared cache, under namespace
+        self._maps = cache.namespace(namespace)
+
+    def warped_shape(self, shape):
+        # shape of the birds' eye view of a frame of the given shape
+        return (int(round(shape[0] * self.scale)),
+                int(round(shape[1] * self.scale)))
+
+    def unwarped_shape(self, shape):
+        return (int(round(shape[0] / self.scale)),
+                int(round(shape[1] / self.scale)))
+
+    def warp_maps(self, shape, inverse=False):
+        """
+          Fixed point remap tables equivalent to transform of frames of the
+          given shape, or with inverse=True, to untransform back to frames of
+          the given shape. Cached per size.
+        """
+        key = ('untransform' if inverse else 'transform', shape[0], shape[1])
+        # one lookup: a shared cache may evict the entry after any other
+        maps = self._maps.get(key)
+        if maps is None:
+            # remap looks up, for each output pixel, its source position
+            if inverse:
+                map_x, map_y = perspective_maps(self._m, shape)
+            else:
+                map_x, map_y = perspective_maps(self._m_inv,
+                                                self.warped_shape(shape))
+            maps = self._maps[key] = cv2.convertMaps(map_x, map_y,
+                                                     cv2.CV_16SC2)
+        return maps
+
+    def source_box(self, shape):
+        """
+          Bounding box (x0, y0, x1, y1) of the pixels of (undistorted) frames
+          of the given shape that transform samples, grown by SOURCE_BORDER
+          and clipped to the frame. Derived from _m_inv once per size, and
+          kept by the instance even when its remap tables are shared.
+        """
+        key = (shape[0], shape[1])
+        if key not in self._boxes:
+            h, w = shape[0], shape[1]
+            map_x, map_y = perspective_maps(self._m_inv,
+                                            self.warped_shape(shape))
+            inside = ((map_x >= 0) & (map_x <= w - 1) &
+                      (map_y >= 0) & (map_y <= h - 1))
+            if not inside.any():
+                self._boxes[key] = (0, 0, w, h)
+                return self._boxes[key]
+            border = BirdsEyeTransform.SOURCE_BORDER
+            x, y = map_x[inside], map_y[inside]
+            self._boxes[key] = (max(int(np.floor(x.min())) - border, 0),
+                                max(int(np.floor(y.min())) - border, 0),
+                                min(int(np.ceil(x.max())) + 1 + border, w),
+                                min(int(np.ceil(y.max())) + 1 + border, h))
+        return self._boxes[key]
+
+    def cropped_warp_maps(self, shape):
+        """
+          Fixed point remap tables equivalent to transform_cropped, cached
+          per size.
+        """
+        key = ('transform_cropped', shape[0], shape[1])
+        maps = self._maps.get(key)
+        if maps is None:
+            x0, y0, _, _ = self.source_box(shape)
+            map_x, map_y = perspective_maps(self._m_inv,
+                                            self.warped_shape(shape))
+            maps = self._maps[key] = cv2.convertMaps(map_x - x0, map_y - y0,
+                                                     cv2.CV_16SC2)
+        return maps
+
+    def raw_maps(self, shape):
+        """
+          Fixed point remap tables taking a raw (distorted) camera frame of the
+          given shape straight to birds' eye view, cached per size.
+        """
+        key = ('raw', shape[0], shape[1])
+        maps = self._maps.get(key)
+        if maps is None:
+            map_x, map_y = perspective_maps(self._m_inv,
+                                            self.warped_shape(shape))
+            u_map_x, u_map_y = self._camera_calibration.undistort_maps(
+                shape, fixed_point=False)
+            # compose: birdseye pixel -> undistorted pixel -> raw pixel
+            raw_x = cv2.remap(u_map_x, map_x, map_y, cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+            raw_y = cv2.remap(u_map_y, map_x, map_y, cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+            # points outside the undistorted frame are sent well outside the
+            # raw frame: remap fills them with zeros without per-pixel
+            # border handling
+            outside = ((map_x < 0) | (map_x > shape[1] - 1) |
+                       (map_y < 0) | (map_y > shape[0] - 1))
+            raw_x[outside] = BirdsEyeTransform._OUTSIDE
+            raw_y[outside] = BirdsEyeTransform._OUTSIDE
+            maps = self._maps[key] = cv2.convertMaps(raw_x, raw_y,
+                                                     cv2.CV_16SC2)
+        return maps
+
     def __transform_point(self, point):
         point = np.asarray([point[0], point[1], 1.0])
         point_t = np.matmul(self._m, point)
@@ -129,6 +367,25 @@ class BirdsEyeTransform:
         return point_t[0:2]
 
 
+def _debug_name(debug_dir, fname, suffix):
+    return os.path.join(debug_dir,
+                        os.path.splitext(os.path.basename(fname))[0] +
+                        suffix + ".jpg")
+
+
+def perspective_maps(m, shape):
+    """
+      Float32 (map_x, map_y) giving, for each pixel of an image of the given
+      shape, the position that the perspective matrix m maps it to.
+    """
+    h, w = shape[0], shape[1]
+    ys, xs = np.indices((h, w), dtype=np.float32)
+    points = np.dstack((xs, ys)).reshape(-1, 1, 2)
+    mapped = cv2.perspectiveTransform(points, m).reshape(h, w, 2)
+    return (np.ascontiguousarray(mapped[:, :, 0]),
+            np.ascontiguousarray(mapped[:, :, 1]))
+
+
 def lines_to_left_right(lines, shape):
     lcount, rcount, lgrad, rgrad, loffset, roffset = (0, 0, 0, 0, 0, 0)
     for line in lines:
@@ -171,38 +428,30 @@ def lines_to_left_right(lines, shape):
 def dash_pixel_length(binary_image, left_line, right_line,
                       line_dist_threshold=8, distinct_dash_threshold=3):
     nonzero = binary_image.nonzero()
-    left_y = []
-    right_y = []
-    for i in range(len(nonzero[0])):
-        p = (nonzero[1][i], nonzero[0][i])
-        if (distance_line_to_point(left_line[0], left_line[1], p) <
-                line_dist_threshold):
-            left_y.append(p[1])
-        if (distance_line_to_point(right_line[0], right_line[1], p) <
-                line_dist_threshold):
-            right_y.append(p[1])
-    left_y.sort(reverse=True)
-    right_y.sort(reverse=True)
+    points = np.column_stack((nonzero[1], nonzero[0]))
     dash_length = binary_image.shape[1]
-    for y_vals in [left_y, right_y]:
-        lengths = []
-        last_y = y_vals[0]
-        current_length = 0
-        for y in y_vals:
-            if (last_y - y) > distinct_dash_threshold:
-                lengths.append(current_length)
-                current_length = 0
-                last_y = y
-            else:
-                current_length += (last_y - y)
-                last_y = y
-        lengths.append(current_length)
-        dash_length = min(dash_length, [l for l in lengths if l > 30][0])
+    for line in [left_line, right_line]:
+        near = (distance_line_to_point(line[0], line[1], points) <
+                line_dist_threshold)
+        y_vals = np.sort(nonzero[0][near])[::-1]
+        # runs of rows separated by gaps of at most distinct_dash_threshold
+        steps = y_vals[:-1] - y_vals[1:]
+        gaps = steps > distinct_dash_threshold
+        run_ids = np.concatenate(([0], np.cumsum(gaps)))
+        lengths = np.bincount(run_ids, weights=np.concatenate(
+                                  ([0], np.where(gaps, 0, steps))))
+        dash_length = min(dash_length, int(lengths[lengths > 30][0]))
     return dash_length
 
 
 def distance_line_to_point(lp1, lp2, p):
-    lp1 = np.asarray(lp1)
-    lp2 = np.asarray(lp2)
+    """
+      Distance from the line through lp1 and lp2 to point p, or to each of an
+      (N, 2) array of points.
+    """
+    lp1 = np.asarray(lp1, dtype=np.float64)
+    lp2 = np.asarray(lp2, dtype=np.float64)
     p = np.asarray(p)
-    return np.linalg.norm(np.cross(lp2-lp1, lp1-p))/np.linalg.norm(lp2-lp1)
+    d = lp2 - lp1
+    cross = d[0] * (lp1[1] - p[..., 1]) - d[1] * (lp1[0] - p[..., 0])
+    return np.abs(cross) / np.hypot(d[0], d[1])
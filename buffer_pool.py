@@ -0,0 +1,52 @@
+"""
+  Preallocated arrays for the stages of one stream, so that processing its
+  frames allocates no full frame arrays after the first. E.g.
+  pool = BufferPool(outputs=2)
+  ll = new_lane_lines()
+  for frame in frames:
+      annotated = process_image(frame, lane_lines=ll, pool=pool)
+  Stages take their scratch arrays from pool.buffer by name, reallocated
+  only when the frame shape changes. Frames handed back to the caller come
+  from a ring of outputs buffers (pool.output), so each stays valid until
+  outputs - 1 further frames have been processed. A pool belongs to one
+  stream, processed on one thread at a time.
+"""
+
+import numpy as np
+
+
+class BufferPool:
+    """
+      Named scratch arrays plus a ring of output arrays. allocations counts
+      the arrays allocated so far, which stops growing once every stage has
+      seen a frame of each shape in use.
+    """
+    def __init__(self, outputs=1):
+        if outputs < 1:
+            raise ValueError("A buffer pool needs at least one output")
+        self.outputs = outputs
+        self.allocations = 0
+        self._buffers = {}
+        self._ring = [None] * outputs
+        self._next = 0
+
+    def _reuse(self, array, shape, dtype):
+        if (array is not None and array.shape == shape and
+                array.dtype == dtype):
+            return array
+        self.allocations += 1
+        return np.empty(shape, dtype)
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        array = self._reuse(self._buffers.get(name), tuple(shape),
+                            np.dtype(dtype))
+        self._buffers[name] = array
+        return array
+
+    def output(self, shape, dtype=np.uint8):
+        # the next array of the output ring
+        index = self._next
+        self._next = (index + 1) % self.outputs
+        array = self._reuse(self._ring[index], tuple(shape), np.dtype(dtype))
+        self._ring[index] = array
+        return array
@@ -0,0 +1,60 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+# bump whenever the meaning of cached values changes
+CACHE_VERSION = 1
+
+
+def cache_key(fnames, *params):
+    """
+      Hex digest identifying a set of input files (by content, in any order)
+      together with the parameters used to process them.
+    """
+    h = hashlib.sha1()
+    h.update(str(CACHE_VERSION).encode())
+    for param in params:
+        if isinstance(param, np.ndarray):
+            h.update(param.tobytes())
+        else:
+            h.update(repr(param).encode())
+    for digest in sorted(file_digest(fname) for fname in fnames):
+        h.update(digest)
+    return h.hexdigest()
+
+
+def file_digest(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def cache_path(cache_dir, name, key):
+    return os.path.join(cache_dir, '{}-{}.npz'.format(name, key))
+
+
+def load(cache_dir, name, key):
+    """
+      Arrays previously stored with save, as a dict, or None if there is no
+      usable cache entry.
+    """
+    try:
+        with np.load(cache_path(cache_dir, name, key)) as data:
+            if int(data['version']) != CACHE_VERSION:
+                return None
+            return {k: data[k] for k in data.files if k != 'version'}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save(cache_dir, name, key, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, so concurrent workers never read a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=CACHE_VERSION, **arrays)
+        os.replace(tmp_path, cache_path(cache_dir, name, key))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -1,6 +1,16 @@
 import glob
+import multiprocessing
+import os
+import warnings
 import cv2
 import numpy as np
+import calibration_cache
+from concurrent.futures import ProcessPoolExecutor
+from batch import *
+
+
+# cornerSubPix half window when refining corners found at reduced scale
+SUBPIX_WINDOW = (11, 11)
 
 
 class CameraCalibration:
@@ -12,35 +22,59 @@ class CameraCalibration:
       where 'camera_cal/calibration*.jpg' is a glob matching a set of images
       taken by the camera, with 9x6 corner chessboard patterns present in the
       images
+      With use_remap=True, undistortion maps are built once per image size
+      (initUndistortRectifyMap) and each call to undistort is a single remap.
+      With cache_dir set, the calibration is stored there keyed by the
+      calibration images' contents and reused by later instances, as are
+      the chessboard corners found in each image, so adding an image to the
+      set costs one corner detection and a calibrateCamera.
+      Corner detection runs across a pool of workers processes (all cores
+      by default). With detect_scale < 1, corners are found on images
+      downscaled by detect_scale and refined at full resolution.
+      Images whose size differs from the most common one are skipped.
+      undistort_batch undistorts a batch of frames across a thread pool.
+      c.share_maps(cache, key) keeps the remap tables in a shared
+      camera_registry.MapCache instead.
     """
     _cal_mtx = None
     _cal_dist = None
 
-    def __init__(self, cal_glob, chess_corners_x=9, chess_corners_y=6):
-        x_shape, y_shape = None, None
+    def __init__(self, cal_glob, chess_corners_x=9, chess_corners_y=6,
+                 use_remap=False, cache_dir=None, workers=None,
+                 detect_scale=1.0):
+        self.use_remap = use_remap
+        self._maps = {}
         objpoints = []
         imgpoints = []
         ret = None
-        images = glob.glob(cal_glob)
+        images = sorted(glob.glob(cal_glob))
+        pattern_size = (chess_corners_x, chess_corners_y)
+        if cache_dir is not None:
+            key = calibration_cache.cache_key(images, chess_corners_x,
+                                              chess_corners_y, detect_scale)
+            cached = calibration_cache.load(cache_dir, 'camera_calibration',
+                                            key)
+            if cached is not None:
+                self._cal_mtx = cached['mtx']
+                self._cal_dist = cached['dist']
+                return
         objp = np.zeros((chess_corners_y*chess_corners_x, 3), np.float32)
         objp[:, :2] = np.mgrid[0:chess_corners_x,
                                0:chess_corners_y].T.reshape(-1, 2)
+        detections = chessboard_corners(images, pattern_size, detect_scale,
+                                        workers, cache_dir)
+        if len(detections) > 0:
+            # consider only images with the most common width and height
+            shapes = [shape for shape, _ in detections]
+            y_shape, x_shape = max(set(shapes), key=shapes.count)
         # for all admissible calibration images, accumulate corners
-        for fname in images:
-            img = cv2.imread(fname)
-            # consider only images with the same width and height as the first
-            if not x_shape:
-                x_shape = img.shape[1]
-                y_shape = img.shape[0]
-            else:
-                if (x_shape != img.shape[1] or y_shape != img.shape[0]):
-                    pass
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            # find the chessboard corners
-            ret, corners = cv2.findChessboardCorners(gray, (chess_corners_x,
-                                                            chess_corners_y),
-                                                     None)
-            if ret:
+        for fname, (shape, corners) in zip(images, detections):
+            if shape != (y_shape, x_shape):
+                warnings.warn("Skipping calibration image %s: %dx%d, not "
+                              "%dx%d" % (fname, shape[1], shape[0], x_shape,
+                                         y_shape))
+                continue
+            if corners is not None:
                 objpoints.append(objp)
                 imgpoints.append(corners)
         # infer mtx and dst from accumulated corners
@@ -53,10 +87,140 @@ class CameraCalibration:
         if ret:
             self._cal_mtx = mtx
             self._cal_dist = dist
+            if cache_dir is not None:
+                calibration_cache.save(cache_dir, 'camera_calibration', key,
+                                       mtx=mtx, dist=dist)
         else:
             raise ValueError("Could not calibrate with images matching %s"
                              % cal_glob)
 
-    def undistort(self, image):
-        return cv2.undistort(image, self._cal_mtx, self._cal_dist, None,
+    def undistort(self, image, dst=None, box=None):
+        """
+          Undistorted image, or with box = (x0, y0, x1, y1) only that region
+          of it (always via remap tables), computed from the whole image.
+        """
+        if box is not None:
+            map1, map2 = self.undistort_maps(image.shape, box=box)
+            return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        if self.use_remap:
+            map1, map2 = self.undistort_maps(image.shape)
+            return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        return cv2.undistort(image, self._cal_mtx, self._cal_dist, dst,
                              self._cal_mtx)
+
+    def undistort_batch(self, frames, out=None, workers=None):
+        """
+          Undistort a batch of frames (an (N, H, W, C) array or a list of
+          frames of one shape) into out, allocated if not given, across
+          workers threads. All frames share one set of remap tables, whether
+          or not use_remap is set.
+        """
+        shape, dtype = batch_shape(frames)
+        map1, map2 = self.undistort_maps(shape)
+        out = output_buffer(out, len(frames), shape, dtype)
+        return map_batch(lambda image, dst: cv2.remap(image, map1, map2,
+                                                      cv2.INTER_LINEAR,
+                                                      dst=dst),
+                         frames, out, workers)
+
+    def share_maps(self, cache, namespace):
+        # keep remap tables in a shared cache, under namespace
+        self._maps = cache.namespace(namespace)
+
+    def undistort_maps(self, shape, fixed_point=True, box=None):
+        """
+          Maps from undistorted pixel coordinates to raw (distorted) pixel
+          coordinates for images of the given shape, cached per size.
+          fixed_point=False returns float32 (map_x, map_y), which can be
+          composed with further coordinate maps. box = (x0, y0, x1, y1)
+          limits the maps to that region of the undistorted image.
+        """
+        key = (shape[0], shape[1], fixed_point, box)
+        # one lookup: a shared cache may evict the entry after any other
+        maps = self._maps.get(key)
+        if maps is None and box is not None:
+            x0, y0, x1, y1 = box
+            maps = self._maps[key] = tuple(
+                np.ascontiguousarray(m[y0:y1, x0:x1])
+                for m in self.undistort_maps(shape, fixed_point))
+        elif maps is None:
+            size = (shape[1], shape[0])
+            map_type = cv2.CV_16SC2 if fixed_point else cv2.CV_32FC1
+            maps = self._maps[key] = cv2.initUndistortRectifyMap(
+                self._cal_mtx, self._cal_dist, None, self._cal_mtx, size,
+                map_type)
+        return maps
+
+
+def find_chessboard_corners(fname, pattern_size, detect_scale=1.0):
+    """
+      Shape (height, width) of a calibration image and the chessboard corners
+      found in it, or None if the pattern is not found. With detect_scale < 1
+      the pattern is found in a downscaled copy, and its corners refined in
+      the full resolution image with cornerSubPix.
+    """
+    img = cv2.imread(fname)
+    if img is None:
+        raise IOError("Could not read image %s" % fname)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if detect_scale == 1.0:
+        ret, corners = cv2.findChessboardCorners(gray, pattern_size, None)
+    else:
+        small = cv2.resize(gray, None, fx=detect_scale, fy=detect_scale,
+                           interpolation=cv2.INTER_AREA)
+        ret, corners = cv2.findChessboardCorners(small, pattern_size, None)
+        if ret:
+            # pixel centres of the downscaled image back to full resolution
+            corners = (corners + 0.5) / detect_scale - 0.5
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
+                        30, 0.01)
+            corners = cv2.cornerSubPix(gray, corners, SUBPIX_WINDOW,
+                                       (-1, -1), criteria)
+    return gray.shape, (corners if ret else None)
+
+
+def chessboard_corners(fnames, pattern_size, detect_scale=1.0, workers=None,
+                       cache_dir=None):
+    """
+      (shape, corners) of each of the calibration images, as given by
+      find_chessboard_corners. Images without an entry in cache_dir (keyed
+      by their contents) are detected across a pool of workers processes,
+      and then cached.
+    """
+    results = [None] * len(fnames)
+    keys = {}
+    missing = []
+    for i, fname in enumerate(fnames):
+        if cache_dir is not None:
+            keys[i] = calibration_cache.cache_key([fname], pattern_size,
+                                                  detect_scale)
+            cached = calibration_cache.load(cache_dir, 'chessboard_corners',
+                                            keys[i])
+            if cached is not None:
+                corners = cached['corners'] if cached['found'] else None
+                results[i] = (tuple(int(n) for n in cached['shape']),
+                              corners)
+                continue
+        missing.append(i)
+    workers = min(workers or os.cpu_count() or 1, len(missing))
+    if multiprocessing.parent_process() is not None:
+        # already in a worker, e.g. a spawned one importing a module that
+        # calibrates at import time: no nested pools
+        workers = 1
+    args = ([fnames[i] for i in missing], [pattern_size] * len(missing),
+            [detect_scale] * len(missing))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            detected = list(pool.map(find_chessboard_corners, *args))
+    else:
+        detected = list(map(find_chessboard_corners, *args))
+    for i, (shape, corners) in zip(missing, detected):
+        results[i] = (shape, corners)
+        if cache_dir is not None:
+            found = corners is not None
+            calibration_cache.save(
+                cache_dir, 'chessboard_corners', keys[i],
+                shape=np.array(shape), found=found,
+                corners=corners if found else np.empty((0, 1, 2),
+                                                       np.float32))
+    return results
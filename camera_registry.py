@@ -0,0 +1,189 @@
+"""
+  Calibrations and birds' eye transforms for many cameras, by camera ID.
+  Cameras are registered with the globs to calibrate them from and loaded
+  on first use (from cache_dir when already computed there). The remap
+  tables of all loaded cameras share one least recently used cache, kept
+  within a memory budget. E.g.
+  cameras = CameraRegistry(map_budget=256 << 20, cache_dir='cache')
+  cameras.register('front', 'camera_cal/calibration*.jpg',
+                   'test_images/straight_lines*jpg')
+  c, t, tw = cameras['front']  # calibration, transform, warp-first transform
+  Cameras may also be described in a JSON file, see CameraRegistry.load.
+"""
+
+import collections
+import json
+import threading
+from camera_calibration import CameraCalibration
+from birdseye_transform import BirdsEyeTransform
+
+Camera = collections.namedtuple('Camera', ['calibration', 'transform',
+                                           'warped_transform'])
+
+
+def _nbytes(value):
+    # memory held by a cached value: an array or a tuple of arrays
+    if isinstance(value, tuple):
+        return sum(_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+class MapCache:
+    """
+      Thread-safe least recently used cache of remap tables within budget
+      bytes, shared by the calibrations and transforms given a namespace
+      of it: cache.namespace(key) is a dict-like view of the entries under
+      key. Read entries with get, which finds and returns one under the
+      lock, as another thread may evict it at any time. Once over budget,
+      least recently used entries are dropped (and rebuilt when next
+      needed), though never the newest.
+    """
+    def __init__(self, budget):
+        self.nbytes = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.budget = budget
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        with self._lock:
+            self._budget = budget
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self._budget and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+            self.evictions += 1
+
+    def namespace(self, key):
+        return _MapCacheNamespace(self, key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= _nbytes(self._entries.pop(key))
+            self._entries[key] = value
+            self.nbytes += _nbytes(value)
+            self._evict()
+
+
+class _MapCacheNamespace:
+    # the entries of a MapCache under one key, as a calibration's or a
+    # transform's own _maps
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+
+    def __contains__(self, key):
+        return (self._key, key) in self._cache
+
+    def __getitem__(self, key):
+        return self._cache[self._key, key]
+
+    def get(self, key, default=None):
+        return self._cache.get((self._key, key), default)
+
+    def __setitem__(self, key, value):
+        self._cache[self._key, key] = value
+
+
+class CameraRegistry:
+    """
+      Camera IDs mapped to their calibration, birds' eye transform and
+      warp-first transform (the transform scaled by warped_scale), loaded
+      when first looked up, with remap tables in a MapCache of map_budget
+      bytes. Lookups are thread-safe; each camera is loaded once.
+    """
+    def __init__(self, map_budget=512 << 20, cache_dir=None, use_remap=True,
+                 warped_scale=0.5):
+        self.maps = MapCache(map_budget)
+        self.cache_dir = cache_dir
+        self.use_remap = use_remap
+        self.warped_scale = warped_scale
+        self._specs = {}
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+    def register(self, camera_id, cal_glob, straight_glob, **calibration_args):
+        """
+          Register a camera calibrated from chessboard images matching
+          cal_glob, with its transform inferred from straight road images
+          matching straight_glob. calibration_args are passed on to
+          CameraCalibration (e.g. chess_corners_x, detect_scale).
+        """
+        with self._lock:
+            self._specs[camera_id] = (cal_glob, straight_glob,
+                                      calibration_args)
+            self._cameras.pop(camera_id, None)
+
+    def load(self, config_path):
+        """
+          Register the cameras of a JSON file mapping camera IDs to objects
+          with cal_glob and straight_glob, and optionally further
+          CameraCalibration arguments.
+        """
+        with open(config_path) as f:
+            config = json.load(f)
+        for camera_id, spec in config.items():
+            spec = dict(spec)
+            self.register(camera_id, spec.pop('cal_glob'),
+                          spec.pop('straight_glob'), **spec)
+
+    def camera_ids(self):
+        return list(self._specs)
+
+    def loaded(self, camera_id):
+        return camera_id in self._cameras
+
+    def __contains__(self, camera_id):
+        return camera_id in self._specs
+
+    def __getitem__(self, camera_id):
+        camera = self._cameras.get(camera_id)
+        if camera is None:
+            with self._lock:
+                camera = self._cameras.get(camera_id)
+                if camera is None:
+                    camera = self._load(camera_id)
+                    self._cameras[camera_id] = camera
+        return camera
+
+    def _load(self, camera_id):
+        if camera_id not in self._specs:
+            raise KeyError("Unknown camera %r, registered cameras are %s"
+                           % (camera_id, sorted(self._specs)))
+        cal_glob, straight_glob, calibration_args = self._specs[camera_id]
+        c = CameraCalibration(cal_glob, use_remap=self.use_remap,
+                              cache_dir=self.cache_dir, **calibration_args)
+        c.share_maps(self.maps, (camera_id, 'calibration'))
+        t = BirdsEyeTransform(c, straight_glob, use_remap=self.use_remap,
+                              cache_dir=self.cache_dir)
+        t.share_maps(self.maps, (camera_id, 'transform'))
+        tw = t.scaled(self.warped_scale)
+        tw.share_maps(self.maps, (camera_id, 'transform', self.warped_scale))
+        return Camera(c, t, tw)
@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 
+"""
+  Extract frames from videos, decoding each video once, sequentially.
+  Frames are selected by count (evenly spaced), stride or explicit indices
+  and written by a pool of threads, as jpg, lossless png or npz images, or
+  as one memory-mapped frame store per video (see frame_store), indexed by
+  frame name and timestamp. E.g.
+  ./extract.py '*.mp4' video_images --count 10
+  ./extract.py project_video.mp4 project_images --stride 5 --format raw
+"""
+
+import argparse
 import os
-from moviepy.editor import *
 import glob
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from frame_store import FrameStore
 
 
 # movie_glob = '*.mp4'
@@ -11,16 +25,153 @@ import glob
 movie_glob = 'project*.mp4'
 imgdir = 'project_images'
 N = 200
+formats = ('jpg', 'png', 'npz', 'raw')
+
+
+def video_info(movie):
+    """
+      Frame count and frames per second of a video.
+    """
+    capture = cv2.VideoCapture(movie)
+    if not capture.isOpened():
+        raise IOError("Could not open video %s" % movie)
+    try:
+        return (int(capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+                capture.get(cv2.CAP_PROP_FPS))
+    finally:
+        capture.release()
+
+
+def select_indices(frame_count, count=None, stride=None, indices=None):
+    """
+      Sorted, distinct indices of the frames to extract: the given indices,
+      every stride'th frame, or count frames evenly spaced over the video.
+    """
+    if indices is not None:
+        selected = np.unique(np.asarray(indices, int))
+        return selected[(selected >= 0) & (selected < frame_count)]
+    if stride is not None:
+        return np.arange(0, frame_count, stride)
+    count = min(count or N, frame_count)
+    return np.unique((np.arange(count) * frame_count) // count)
+
+
+def selected_frames(movie, indices):
+    """
+      (index, RGB frame) for each of the sorted frame indices of a video,
+      decoding it once from the start. Frames in between are decoded but
+      not converted.
+    """
+    capture = cv2.VideoCapture(movie)
+    if not capture.isOpened():
+        raise IOError("Could not open video %s" % movie)
+    try:
+        index = 0
+        for wanted in indices:
+            while index < wanted:
+                if not capture.grab():
+                    return
+                index += 1
+            ok, frame = capture.read()
+            if not ok:
+                return
+            index += 1
+            yield wanted, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    finally:
+        capture.release()
+
+
+def frame_name(movie, timestamp):
+    return os.path.splitext(os.path.basename(movie))[0] + \
+        '-{}'.format(timestamp)
+
+
+def write_image(path, frame):
+    if path.endswith('.npz'):
+        np.savez_compressed(path, frame=frame)
+    elif not cv2.imwrite(path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)):
+        raise IOError("Could not write image %s" % path)
+
+
+def extract_frames(movie, imgdir, count=None, stride=None, indices=None,
+                   fmt='jpg', workers=4):
+    """
+      Extract the selected frames of movie into imgdir, returning the paths
+      written. Image formats are named by movie and timestamp; raw output is
+      one <movie> frame store of all selected frames, in index order, whose
+      index holds the same names.
+    """
+    frame_count, fps = video_info(movie)
+    wanted = select_indices(frame_count, count, stride, indices)
+    os.makedirs(imgdir, exist_ok=True)
+    if fmt == 'raw':
+        return [extract_raw(movie, imgdir, wanted, workers)]
+    paths = []
+    max_pending = 4 * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for index, frame in selected_frames(movie, wanted):
+            path = os.path.join(imgdir, frame_name(movie, index / fps) +
+                                '.' + fmt)
+            pending.append(pool.submit(write_image, path, frame))
+            paths.append(path)
+            # bound the frames held in memory by queued writes
+            if len(pending) >= max_pending:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+    return paths
 
 
-def extract_frames(movie, imgdir):
-    clip = VideoFileClip(movie)
-    times = [(i*(clip.duration/N)) for i in range(N)]
-    for t in times:
-        imgpath = os.path.join(imgdir, movie[:-4] + '-{}.jpg'.format(t))
-        clip.save_frame(imgpath, t)
+def extract_raw(movie, imgdir, indices, workers=4):
+    path = os.path.join(imgdir, os.path.splitext(os.path.basename(movie))[0])
+    _, fps = video_info(movie)
+    frames = selected_frames(movie, indices)
+    try:
+        _, first = next(frames)
+    except StopIteration:
+        raise IOError("No frames decoded from %s" % movie)
+    store = FrameStore.create(
+        path, len(indices), first.shape,
+        names=[frame_name(movie, index / fps) for index in indices],
+        timestamps=[index / fps for index in indices])
+    store.frames[0] = first
+    written = 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i, (_, frame) in enumerate(frames, 1):
+            futures.append(pool.submit(store.frames.__setitem__, i, frame))
+            written += 1
+            if len(futures) >= 4 * workers:
+                futures.pop(0).result()
+        for future in futures:
+            future.result()
+    if written < len(indices):
+        raise IOError("Decoded %d of %d frames of %s" % (written,
+                                                         len(indices), movie))
+    store.flush()
+    return path + '.npy'
 
 
-movies = glob.glob(movie_glob)
-for movie in movies:
-    extract_frames(movie, imgdir)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('movies', nargs='?', default=movie_glob,
+                        help='glob of videos (default %(default)s)')
+    parser.add_argument('imgdir', nargs='?', default=imgdir)
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--count', type=int, default=N,
+                           help='frames evenly spaced over each video')
+    selection.add_argument('--stride', type=int,
+                           help='every stride-th frame')
+    selection.add_argument('--indices', type=int, nargs='+',
+                           help='frame indices')
+    parser.add_argument('--format', choices=formats, default='jpg')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='writer threads')
+    args = parser.parse_args()
+    for movie in glob.glob(args.movies):
+        extract_frames(movie, args.imgdir, count=args.count,
+                       stride=args.stride, indices=args.indices,
+                       fmt=args.format, workers=args.workers)
@@ -0,0 +1,124 @@
+"""
+  Frame stores: the frames of a video, or of a set of images, kept as one
+  memory-mapped uint8 array of shape (N, H, W, 3) in <path>.npy, with an
+  index of frame names and timestamps (seconds, or None for images) in
+  <path>.json. Reading a store decodes nothing, and slices of it are views
+  of the mapped file. E.g.
+  store = FrameStore.open('project_images/project_video')
+  store.frames[100:200]  # zero-copy
+  store.names[100], store.timestamps[100]
+  store = image_store('video_images/*.jpg', 'cache')  # built on first use
+"""
+
+import glob
+import json
+import os
+import numpy as np
+import matplotlib.image as mpimg
+import calibration_cache
+
+
+class FrameStore:
+    """
+      A memory-mapped array of RGB frames plus their names and timestamps.
+      Use FrameStore.open to read an existing store (read-only by default)
+      and FrameStore.create to write a new one: fill store.frames, names and
+      timestamps, then call store.flush().
+    """
+    def __init__(self, path, frames, names, timestamps):
+        self.path = path
+        self.frames = frames
+        self.names = names
+        self.timestamps = timestamps
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        path = store_path(path)
+        frames = np.load(path + '.npy', mmap_mode=mode)
+        with open(path + '.json') as f:
+            index = json.load(f)
+        if len(index['names']) != len(frames):
+            raise ValueError("Frame store %s has %d frames but %d names"
+                             % (path, len(frames), len(index['names'])))
+        return cls(path, frames, index['names'], index['timestamps'])
+
+    @classmethod
+    def create(cls, path, count, frame_shape, names=None, timestamps=None):
+        path = store_path(path)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        frames = np.lib.format.open_memmap(path + '.npy', mode='w+',
+                                           dtype=np.uint8,
+                                           shape=(count,) + tuple(frame_shape))
+        names = list(names) if names is not None else [
+            'frame-{:06d}'.format(i) for i in range(count)]
+        timestamps = (list(timestamps) if timestamps is not None
+                      else [None] * count)
+        return cls(path, frames, names, timestamps)
+
+    def flush(self):
+        """
+          Write the frames and the index to disk.
+        """
+        self.frames.flush()
+        tmp_path = self.path + '.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'names': self.names, 'timestamps': self.timestamps},
+                      f)
+        os.replace(tmp_path, self.path + '.json')
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+
+def store_path(path):
+    # a store may be named with or without its .npy extension
+    return path[:-4] if path.endswith('.npy') else path
+
+
+def is_store(path):
+    path = store_path(path)
+    return os.path.exists(path + '.npy') and os.path.exists(path + '.json')
+
+
+def image_store(image_glob, store_dir, name='images'):
+    """
+      Frame store of the images matching a glob, in file name order, built
+      in store_dir on first use and reused while the images and their names
+      are unchanged.
+      Frames are decoded as mpimg.imread decodes them.
+    """
+    fnames = sorted(glob.glob(image_glob))
+    if len(fnames) == 0:
+        raise IOError("No images match %s" % image_glob)
+    # keyed by each file's name and content, in order, so that renamed or
+    # reordered images build a new store
+    key = calibration_cache.cache_key(
+        (), [(os.path.basename(fname), calibration_cache.file_digest(fname))
+             for fname in fnames])
+    path = os.path.join(store_dir, '{}-{}'.format(name, key))
+    if is_store(path):
+        return FrameStore.open(path)
+    first = mpimg.imread(fnames[0])
+    store = FrameStore.create(
+        path + '.tmp', len(fnames), first.shape,
+        names=[os.path.splitext(os.path.basename(f))[0] for f in fnames])
+    for i, fname in enumerate(fnames):
+        image = first if i == 0 else mpimg.imread(fname)
+        if image.shape != first.shape:
+            raise ValueError("Image %s is %s, not %s like %s"
+                             % (fname, image.shape, first.shape, fnames[0]))
+        store.frames[i] = image
+    store.flush()
+    del store
+    # publish the store only once complete
+    os.replace(path + '.tmp.npy', path + '.npy')
+    os.replace(path + '.tmp.json', path + '.json')
+    return FrameStore.open(path)
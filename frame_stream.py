@@ -0,0 +1,201 @@
+"""
+  Streaming of frames from a source, through a processing function, to a sink.
+  A source is any iterable of RGB frames: video_frames and image_frames
+  generators, a list, or an (N, H, W, 3) numpy array. A sink is any object
+  with write(frame) and close() methods, such as VideoSink or ImageSink.
+  E.g.
+  stream(video_frames('project_video.mp4'), process_image,
+         VideoSink('output_images/project_video.mp4',
+                   video_fps('project_video.mp4')))
+"""
+
+import glob
+import os
+import queue
+import threading
+import cv2
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def video_frames(path):
+    """
+      RGB frames of a video file, or of a live camera given its index.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError("Could not open video source %s" % str(path))
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    finally:
+        capture.release()
+
+
+def video_fps(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        return capture.get(cv2.CAP_PROP_FPS)
+    finally:
+        capture.release()
+
+
+def image_frames(image_glob):
+    """
+      RGB frames of the images matching a glob, in file name order.
+    """
+    for fname in sorted(glob.glob(image_glob)):
+        image = cv2.imread(fname)
+        if image is None:
+            raise IOError("Could not read image %s" % fname)
+        yield cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+
+class VideoSink:
+    """
+      Writes RGB frames to a video file, opened when the first frame arrives.
+    """
+    def __init__(self, path, fps, fourcc='mp4v'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self._writer = None
+
+    def write(self, frame):
+        if self._writer is None:
+            size = (frame.shape[1], frame.shape[0])
+            self._writer = cv2.VideoWriter(
+                self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps,
+                size)
+            if not self._writer.isOpened():
+                raise IOError("Could not open video sink %s" % self.path)
+        self._writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+
+
+class ImageSink:
+    """
+      Writes RGB frames to numbered image files in out_dir, or, given names,
+      to files named name_format.format(names[i]) for the i'th frame.
+    """
+    def __init__(self, out_dir, name_format='frame-{:06d}.jpg', names=None):
+        self.out_dir = out_dir
+        self.name_format = name_format
+        self.names = names
+        self._count = 0
+
+    def write(self, frame):
+        name = (self._count if self.names is None
+                else self.names[self._count])
+        fname = os.path.join(self.out_dir, self.name_format.format(name))
+        if not cv2.imwrite(fname, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)):
+            raise IOError("Could not write image %s" % fname)
+        self._count += 1
+
+    def close(self):
+        pass
+
+
+def prefetch(frames, maxsize=4):
+    """
+      Iterate over frames produced by a background thread, which runs at most
+      maxsize frames ahead of the consumer. Exceptions raised by the source
+      are re-raised in the consumer.
+    """
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # returns False once the consumer has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for frame in frames:
+                if not put(frame):
+                    return
+            put(_END)
+        except BaseException as e:
+            put(_Failure(e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def frames_in_flight(maxsize=4):
+    # results of process a stream holds at once: up to maxsize queued, one
+    # being written and one being produced
+    return maxsize + 2
+
+
+def stream(frames, process, sink, maxsize=4):
+    """
+      Pull frames from a source, pass each through process and push the
+      results to sink, returning the number of frames written. Reading and
+      writing run on background threads, each at most maxsize frames away
+      from processing, so memory stays bounded however long the stream.
+      The sink is closed at the end, and any exception raised by the source,
+      process or sink is raised here. process may reuse the arrays it
+      returns once frames_in_flight(maxsize) further frames have gone by,
+      so a process sized for one maxsize must be streamed with the same.
+    """
+    buffer = queue.Queue(maxsize)
+    failures = []
+
+    def consume():
+        try:
+            while True:
+                item = buffer.get()
+                if item is _END:
+                    return
+                sink.write(item)
+        except BaseException as e:
+            failures.append(e)
+            # keep draining so processing is never blocked on a dead writer
+            while buffer.get() is not _END:
+                pass
+
+    writer = threading.Thread(target=consume, daemon=True)
+    writer.start()
+    count = 0
+    try:
+        for frame in prefetch(frames, maxsize):
+            if failures:
+                break
+            buffer.put(process(frame))
+            count += 1
+    finally:
+        buffer.put(_END)
+        writer.join()
+        sink.close()
+    if failures:
+        raise failures[0]
+    return count
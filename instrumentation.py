@@ -0,0 +1,164 @@
+"""
+  Per-stage timing, counters and allocation tracking for the lane pipeline.
+  Pipeline code marks stages and counts events through the module level
+  stage and count functions, which do nothing unless an Instrumentation is
+  active. E.g.
+  inst = Instrumentation()
+  with inst.active():
+      for image in images:
+          with inst.frame():
+              process_image(image)
+  inst.records    # one dict per frame: stage seconds, counters, allocations
+  inst.summary()  # p50/p95/p99 over the run for each stage and counter
+  latency_stats(seconds) summarizes any list of durations the same way.
+"""
+
+import contextlib
+import time
+import tracemalloc
+import numpy as np
+
+_active = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """
+      Context manager timing a named stage of the current frame.
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name)
+
+
+def count(name, n=1):
+    """
+      Add n to a named counter of the current frame.
+    """
+    if _active is not None:
+        _active.count(name, n)
+
+
+class _Stage:
+    def __init__(self, record, name):
+        self._record = record
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = self._record['stages']
+        stages[self._name] = (stages.get(self._name, 0.0) +
+                              time.perf_counter() - self._start)
+        return False
+
+
+class Instrumentation:
+    """
+      Collects one record per frame of wall clock seconds per stage, event
+      counters and, with track_allocations=True, the peak memory allocated
+      while processing the frame (via tracemalloc, which is slow).
+    """
+    def __init__(self, track_allocations=False):
+        self.track_allocations = track_allocations
+        self.records = []
+        self._record = None
+
+    @contextlib.contextmanager
+    def active(self):
+        """
+          Make this the instrumentation that stage and count report to.
+        """
+        global _active
+        previous = _active
+        _active = self
+        started_tracing = False
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        try:
+            yield self
+        finally:
+            _active = previous
+            if started_tracing:
+                tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def frame(self):
+        """
+          Collect a record for the frame processed within this context.
+        """
+        record = {'stages': {}, 'counters': {}}
+        self._record = record
+        if self.track_allocations:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['total'] = time.perf_counter() - start
+            if self.track_allocations:
+                record['allocated_peak'] = (tracemalloc.get_traced_memory()[1]
+                                            - start_memory)
+            self._record = None
+            self.records.append(record)
+
+    def stage(self, name):
+        if self._record is None:
+            return _NULL_STAGE
+        return _Stage(self._record, name)
+
+    def count(self, name, n=1):
+        if self._record is not None:
+            counters = self._record['counters']
+            counters[name] = counters.get(name, 0) + n
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """
+          For each stage (in milliseconds), counter and the frame total, the
+          mean and given percentiles over all frames recorded so far.
+        """
+        series = {}
+        for record in self.records:
+            series.setdefault('total', []).append(1000 * record['total'])
+            for name, seconds in record['stages'].items():
+                series.setdefault(name, []).append(1000 * seconds)
+            for name, value in record['counters'].items():
+                series.setdefault(name, []).append(value)
+            if 'allocated_peak' in record:
+                series.setdefault('allocated_peak', []).append(
+                    record['allocated_peak'])
+        summary = {}
+        for name, values in series.items():
+            stats = {'frames': len(values), 'mean': float(np.mean(values))}
+            for p, value in zip(percentiles,
+                                np.percentile(values, percentiles)):
+                stats['p%d' % p] = float(value)
+            summary[name] = stats
+        return summary
+
+
+def latency_stats(seconds):
+    """
+      Run count, mean, minimum and p50/p95/p99 in milliseconds of a sequence
+      of durations in seconds.
+    """
+    ms = 1000 * np.asarray(seconds)
+    return {'runs': len(ms), 'mean_ms': float(np.mean(ms)),
+            'min_ms': float(np.min(ms)),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)),
+            'p99_ms': float(np.percentile(ms, 99))}
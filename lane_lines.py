@@ -1,36 +1,326 @@
 import cv2
 import numpy as np
+import instrumentation
+
+# what LaneLines.update draws, in increasing cost
+RENDER_NONE = 0   # fits, curvature and displacement only
+RENDER_LANE = 1   # plus the lane overlay image
+RENDER_DEBUG = 2  # plus the search window visualization
+
+
+def nonzero_pixels(binary_image):
+    """
+      x and y coordinates of the nonzero pixels of a binary image, in row
+      major order (so y is sorted).
+    """
+    points = cv2.findNonZero(binary_image)
+    if points is None:
+        empty = np.empty(0, np.int32)
+        return empty, empty
+    return points[:, 0, 0], points[:, 0, 1]
+
+
+def gray_image(binary_image, dst=None):
+    # a single channel image as three identical channels
+    return cv2.merge((binary_image, binary_image, binary_image), dst=dst)
+
+
+def reduce_mask(binary_image, factor):
+    """
+      A binary image reduced by factor (a power of two) in both directions:
+      nonzero where any pixel of the corresponding factor x factor block is,
+      by repeated 2x2 area averages of a 0/255 mask, which keep a single set
+      pixel nonzero. Trailing rows and columns that do not fill a block are
+      dropped.
+    """
+    if factor < 1 or factor & (factor - 1):
+        raise ValueError("Masks are reduced by a power of two, not %r"
+                         % factor)
+    h, w = binary_image.shape[:2]
+    mask = cv2.compare(binary_image[:h - h % factor, :w - w % factor], 0,
+                       cv2.CMP_GT)
+    while factor > 1:
+        mask = cv2.resize(mask, (mask.shape[1] // 2, mask.shape[0] // 2),
+                          interpolation=cv2.INTER_AREA)
+        factor //= 2
+    return mask
+
+
+def band_pixels(binary_image, fit, margin, strip_rows=48):
+    """
+      x and y coordinates of the nonzero pixels of a binary image within
+      +/- margin (exclusive) of x = polyval(fit, y), in row major order.
+      Rows are searched in strips of strip_rows, each only across the
+      columns the band spans there, so the cost follows the band's area
+      rather than the image's.
+    """
+    h, w = binary_image.shape[:2]
+    fitx = np.polyval(fit, np.arange(h))
+    starts = np.arange(0, h, strip_rows)
+    lows = np.maximum(np.floor(np.minimum.reduceat(fitx, starts) - margin),
+                      0).astype(int)
+    highs = np.minimum(np.ceil(np.maximum.reduceat(fitx, starts) + margin)
+                       + 1, w).astype(int)
+    xs, ys = [], []
+    for y0, x0, x1 in zip(starts, lows, highs):
+        if x0 < x1:
+            points = cv2.findNonZero(binary_image[y0:y0 + strip_rows, x0:x1])
+            if points is not None:
+                xs.append(points[:, 0, 0] + x0)
+                ys.append(points[:, 0, 1] + y0)
+    if not xs:
+        empty = np.empty(0, np.int32)
+        return empty, empty
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    inside = np.abs(x - fitx[y]) < margin
+    return x[inside], y[inside]
+
+
+class LaneFit:
+    """
+      Least squares fit of x = a*y**2 + b*y + c to lane line pixels, kept as
+      the sums of the normal equations so that pixels can be added in
+      batches, weighted, and carried over from earlier frames:
+      fit = LaneFit(height)
+      fit.add(x, y)
+      a, b, c = fit.coefficients()  # as np.polyfit(y, x, 2)
+      fit.decay(0.5)  # halve the weight of the pixels added so far
+      Pixels are accumulated per row (y must be integer rows in
+      [0, height)): exact integer counts and x totals, followed by products
+      with fixed row powers, with y scaled to [0, 1] for conditioning.
+    """
+    def __init__(self, height):
+        self.height = height
+        rows = np.arange(height) / max(height - 1, 1)
+        self._powers = np.vstack([rows ** k for k in range(5)])
+        self.reset()
+
+    def reset(self):
+        # sums of w*t**k for k = 0..4 and of w*x*t**k for k = 0..2
+        self._t_sums = np.zeros(5)
+        self._xt_sums = np.zeros(3)
+
+    @property
+    def weight(self):
+        # total weight of the pixels accumulated
+        return self._t_sums[0]
+
+    def add(self, x, y, weights=None):
+        # weights multiply squared residuals (np.polyfit's w squared)
+        counts = np.bincount(y, weights=weights, minlength=self.height)
+        x_weights = x if weights is None else x * weights
+        x_totals = np.bincount(y, weights=x_weights, minlength=self.height)
+        self._t_sums += np.dot(self._powers, counts)
+        self._xt_sums += np.dot(self._powers[:3], x_totals)
+        return self
+
+    def decay(self, factor):
+        self._t_sums *= factor
+        self._xt_sums *= factor
+        return self
+
+    def coefficients(self):
+        s, r = self._t_sums, self._xt_sums
+        normal = np.array([[s[4], s[3], s[2]],
+                           [s[3], s[2], s[1]],
+                           [s[2], s[1], s[0]]])
+        rhs = np.array([r[2], r[1], r[0]])
+        try:
+            a, b, c = np.linalg.solve(normal, rhs)
+        except np.linalg.LinAlgError:
+            # fewer than three distinct rows: minimum norm solution
+            a, b, c = np.linalg.lstsq(normal, rhs, rcond=None)[0]
+        # back from t = y/(height - 1) to y
+        scale = 1.0 / max(self.height - 1, 1)
+        return np.array([a * scale ** 2, b * scale, c])
+
+
+def scale_fit(fit, factor):
+    """
+      Coefficients of a lane line fit for images scaled by factor.
+    """
+    # x*f = a*f*(y*f/f)**2 + ... = (a/f)*(y*f)**2 + b*(y*f) + c*f
+    return np.array([fit[0] / factor, fit[1], fit[2] * factor])
+
+
+def radius_of_curvature(fit, y, meters_per_pixel):
+    """
+      Radius of curvature in meters, at row y, of a lane line fitted in
+      pixels (x = a*y**2 + b*y + c), on an image of meters_per_pixel in
+      both directions.
+    """
+    a, b = fit[0], fit[1]
+    # in meters x = (a/mpp)*y**2 + b*y + c*mpp, evaluated at y*mpp
+    return ((1 + (2 * a * y + b) ** 2) ** 1.5 /
+            np.absolute(2 * a / meters_per_pixel))
 
 
 class LaneLines:
+    """
+      Lane line tracker for a stream of birds' eye view binary images.
+      ll = LaneLines(t.meters_per_pixel)
+      lane_img, curvature, displacement, window_img = ll.update(binary_warped)
+      The render level limits what is drawn: with RENDER_LANE window_img is
+      None, with RENDER_NONE lane_img is None too, and the fits are read
+      from ll.left_fit and ll.right_fit. ll.lane_polygons gives the lane
+      overlay as polygons, to draw at any resolution or perspective.
+      Once a confident fit is found, the next update searches only a band
+      around it, falling back to the sliding window search when the band
+      yields too few pixels or an implausible lane width. Use one instance
+      per stream and reset() it on discontinuities. update(..., pool=pool)
+      renders into the arrays of the stream's buffer_pool.BufferPool,
+      overwritten by the next update.
+      Pixel hyperparameters are tuned for full resolution birds' eye images;
+      pass the transform's scale when working on scaled ones:
+      ll = LaneLines(ts.meters_per_pixel, scale=ts.scale)
+      Lines are fitted with LaneFit. With memory > 0, while the lane is
+      tracked each fit also includes the pixels of earlier frames, weighted
+      by memory per frame of age.
+      The sliding window search uses nwindows windows per line, each
+      +/- margin pixels wide, recentred on the mean of more than minpix
+      pixels, with the lines' bases sought offset pixels either side of the
+      image centre (all at full resolution). With seed_bases, the first
+      windows are instead centred on the peaks of a column histogram of the
+      image's bottom half within offset/2 of those positions, which follows
+      lines off the expected positions (a car off centre, a wider lane) but
+      can also lock onto other strong edges there; it is off by default, so
+      detection matches the fixed bases.
+      With coarse = 2 or 4 (coarse-to-fine mode), the sliding windows run on
+      the mask reduced by coarse (reduce_mask), and lines are then fitted to
+      the full resolution pixels within REFINE_MARGIN of a fit to the coarse
+      ones. In every mode, the search around prior fits gathers only the
+      pixels of its bands (band_pixels) instead of all of the image's.
+    """
+    SEARCH_MARGIN = 24  # pixels either side of the prior fit
+    MIN_LANE_PIXELS = 100
+    LANE_WIDTH_RANGE = (2.5, 5.0)  # meters
+    POLYGON_STEP = 8  # rows between lane overlay vertices
+    REFINE_MARGIN = 12  # pixels either side of a coarse fit
+    COARSE_FACTORS = (1, 2, 4)
+
     _lanes_found = False
     _meters_per_pixel = None
+    _scale = 1.0
+    _left_fit = None
+    _right_fit = None
+    _previous_fits = None
+    _fits = None
 
-    def __init__(self, meters_per_pixel):
+    def __init__(self, meters_per_pixel, scale=1.0, memory=0.0, nwindows=9,
+                 margin=16, minpix=25, offset=44, coarse=1,
+                 seed_bases=False):
         self._meters_per_pixel = meters_per_pixel
+        self._scale = scale
+        self.memory = memory
+        self.nwindows = nwindows
+        self.margin = margin
+        self.minpix = minpix
+        self.offset = offset
+        if coarse not in LaneLines.COARSE_FACTORS:
+            raise ValueError("coarse must be one of %s, not %r"
+                             % (LaneLines.COARSE_FACTORS, coarse))
+        self.coarse = coarse
+        self.seed_bases = seed_bases
+
+    def _px(self, length):
+        # a full resolution length in pixels, at the working scale
+        return max(1, int(round(length * self._scale)))
+
+    def _count(self, count):
+        # a full resolution pixel count, at the working scale
+        return max(1, int(round(count * self._scale ** 2)))
+
+    @property
+    def left_fit(self):
+        return self._left_fit
+
+    @property
+    def right_fit(self):
+        return self._right_fit
 
-    def find_lane_pixels(self, binary_warped):
-        # Create an output image to draw on and visualize the result
-        out_img = np.dstack((binary_warped, binary_warped, binary_warped))
-        offset = 44
-        midpoint = binary_warped.shape[1]//2
-        leftx_base = midpoint - offset
-        rightx_base = midpoint + offset
+    @property
+    def lanes_found(self):
+        # whether the last update found a plausible lane
+        return self._lanes_found
+
+    def reset(self):
+        self._lanes_found = False
+        self._left_fit = None
+        self._right_fit = None
+        self._previous_fits = None
+        self._fits = None
+
+    def follow(self, other):
+        """
+          Continue tracking from another LaneLines' state, converting its fits
+          to this instance's scale, e.g. when switching between full and
+          reduced resolution birds' eye images mid-stream.
+        """
+        self.reset()
+        if other._left_fit is None:
+            return
+        factor = self._scale / other._scale
+        self._left_fit = scale_fit(other._left_fit, factor)
+        self._right_fit = scale_fit(other._right_fit, factor)
+        if other._previous_fits is not None:
+            self._previous_fits = tuple(scale_fit(fit, factor)
+                                        for fit in other._previous_fits)
+        self._lanes_found = other._lanes_found
+
+    def extrapolate(self, shape):
+        """
+          Advance the fits by one frame without an image, by the change
+          between the last two fits, for frames whose detection is skipped.
+          Returns the radius of curvature and displacement, as update does
+          for birds' eye images of the given shape.
+        """
+        if self._left_fit is None:
+            raise ValueError("No lane fit to extrapolate")
+        current = (self._left_fit, self._right_fit)
+        if self._previous_fits is not None:
+            self._left_fit, self._right_fit = (
+                2 * fit - previous
+                for fit, previous in zip(current, self._previous_fits))
+        self._previous_fits = current
+        instrumentation.count('extrapolated_fits')
+        return self._measure(shape)
+
+    def _measure(self, shape):
+        # radius of curvature and vehicle displacement from lane centre, at
+        # the bottom of the image
+        mpp = self._meters_per_pixel
+        y_eval = shape[0] - 1
+        left_radius_of_curvature = radius_of_curvature(self._left_fit,
+                                                       y_eval, mpp)
+        displacement = mpp * ((shape[1] / 2) -
+                              ((np.polyval(self._left_fit, y_eval) +
+                                np.polyval(self._right_fit, y_eval)) / 2))
+        return left_radius_of_curvature, displacement
+
+    def find_lane_pixels(self, binary_warped, draw=True, out_img=None):
+        # Create an output image to draw on and visualize the result (in
+        # out_img, if given)
+        out_img = gray_image(binary_warped, out_img) if draw else None
+        height = binary_warped.shape[0]
 
         # HYPERPARAMETERS
         # number of sliding windows
-        nwindows = 9
+        nwindows = self.nwindows
         # width of windows set to +/- margin
-        margin = 16
+        margin = self._px(self.margin)
         # minimum number of pixels found to recenter window
-        minpix = 25
+        minpix = self._count(self.minpix)
 
         # height of windows - based on nwindows above and image shape
-        window_height = np.int(binary_warped.shape[0]//nwindows)
-        # Identify the x and y positions of all nonzero pixels in the image
-        nonzero = binary_warped.nonzero()
-        nonzeroy = np.array(nonzero[0])
-        nonzerox = np.array(nonzero[1])
+        window_height = int(height//nwindows)
+        # Identify the x and y positions of all nonzero pixels in the image;
+        # nonzeroy is sorted, so the pixels of any band of rows are a
+        # contiguous slice
+        nonzerox, nonzeroy = nonzero_pixels(binary_warped)
+        instrumentation.count('nonzero_pixels', len(nonzerox))
+
+        leftx_base, rightx_base = self._window_bases(
+            nonzerox, nonzeroy, binary_warped.shape)
         # Current positions to be updated later for each window in nwindows
         leftx_current = leftx_base
         rightx_current = rightx_base
@@ -44,27 +334,30 @@ class LaneLines:
         stop_right = 0
         for window in range(nwindows):
             # Identify window boundaries in x and y (and right and left)
-            win_y_low = binary_warped.shape[0] - (window+1)*window_height
-            win_y_high = binary_warped.shape[0] - window*window_height
+            win_y_low = height - (window+1)*window_height
+            win_y_high = height - window*window_height
             win_xleft_low = leftx_current - margin
             win_xleft_high = leftx_current + margin
             win_xright_low = rightx_current - margin
             win_xright_high = rightx_current + margin
 
             # Draw the windows on the visualization image
-            cv2.rectangle(out_img, (win_xleft_low, win_y_low),
-                          (win_xleft_high, win_y_high), (0, 255, 0), 2)
-            cv2.rectangle(out_img, (win_xright_low, win_y_low),
-                          (win_xright_high, win_y_high), (0, 255, 0), 2)
-            # Identify the nonzero pixels in x and y within the window #
-            good_left_inds = ((nonzeroy >= win_y_low) &
-                              (nonzeroy < win_y_high) &
-                              (nonzerox >= win_xleft_low) &
-                              (nonzerox < win_xleft_high)).nonzero()[0]
-            good_right_inds = ((nonzeroy >= win_y_low) &
-                               (nonzeroy < win_y_high) &
-                               (nonzerox >= win_xright_low) &
-                               (nonzerox < win_xright_high)).nonzero()[0]
+            if draw:
+                cv2.rectangle(out_img, (win_xleft_low, win_y_low),
+                              (win_xleft_high, win_y_high), (0, 255, 0), 2)
+                cv2.rectangle(out_img, (win_xright_low, win_y_low),
+                              (win_xright_high, win_y_high), (0, 255, 0), 2)
+            # Identify the nonzero pixels in x and y within the window,
+            # looking only at the window's own band of rows
+            band_low, band_high = np.searchsorted(nonzeroy,
+                                                  (win_y_low, win_y_high))
+            band_x = nonzerox[band_low:band_high]
+            good_left_inds = band_low + ((band_x >= win_xleft_low) &
+                                         (band_x < win_xleft_high)
+                                         ).nonzero()[0]
+            good_right_inds = band_low + ((band_x >= win_xright_low) &
+                                          (band_x < win_xright_high)
+                                          ).nonzero()[0]
 
             # Append these indices to the lists
             left_lane_inds.append(good_left_inds)
@@ -72,15 +365,14 @@ class LaneLines:
 
             # recenter next window, if enough pixels found
             if len(good_left_inds) > minpix and stop_left < 2:
-                leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
+                leftx_current = int(np.mean(nonzerox[good_left_inds]))
+                instrumentation.count('windows_recentered')
             if len(good_right_inds) > minpix and stop_right < 2:
-                rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
+                rightx_current = int(np.mean(nonzerox[good_right_inds]))
+                instrumentation.count('windows_recentered')
 
-        try:
-            left_lane_inds = np.concatenate(left_lane_inds)
-            right_lane_inds = np.concatenate(right_lane_inds)
-        except ValueError:
-            pass
+        left_lane_inds = np.concatenate(left_lane_inds)
+        right_lane_inds = np.concatenate(right_lane_inds)
 
         # Extract left and right line pixel positions
         leftx = nonzerox[left_lane_inds]
@@ -90,66 +382,207 @@ class LaneLines:
 
         return leftx, lefty, rightx, righty, out_img
 
-    def update(self, binary_warped):
-        bw = binary_warped
-        # Obtain lane pixels
-        leftx, lefty, rightx, righty, window_img = self.find_lane_pixels(bw)
+    def _window_bases(self, nonzerox, nonzeroy, shape):
+        # x of the left and right lines' first windows: offset either side
+        # of the image centre, or with seed_bases, the column histogram
+        # peaks of the bottom half within half an offset of those
+        offset = self._px(self.offset)
+        midpoint = shape[1]//2
+        if not self.seed_bases:
+            return midpoint - offset, midpoint + offset
+        bottom_half = np.searchsorted(nonzeroy, shape[0]//2)
+        histogram = np.bincount(nonzerox[bottom_half:], minlength=shape[1])
+        return (self._histogram_peak(histogram, midpoint - offset,
+                                     offset//2),
+                self._histogram_peak(histogram, midpoint + offset,
+                                     offset//2))
 
-        # Fit a second order polynomial to each using `np.polyfit`
-        left_fit = np.polyfit(lefty, leftx, 2)
-        right_fit = np.polyfit(righty, rightx, 2)
+    @staticmethod
+    def _histogram_peak(histogram, expected, spread):
+        # column of the histogram peak within expected +/- spread, or
+        # expected if there are no pixels there
+        low = max(expected - spread, 0)
+        high = expected + spread + 1
+        if not histogram[low:high].any():
+            return expected
+        return low + int(np.argmax(histogram[low:high]))
 
-        # Generate x and y values for plotting
-        ploty = np.linspace(0, bw.shape[0] - 1,
-                            bw.shape[0])
-        try:
-            left_fitx = (left_fit[0] * ploty ** 2 +
-                         left_fit[1] * ploty + left_fit[2])
-            right_fitx = (right_fit[0] * ploty ** 2 +
-                          right_fit[1] * ploty + right_fit[2])
-        except TypeError:
-            left_fitx = 1 * ploty ** 2 + 1 * ploty
-            right_fitx = 1 * ploty ** 2 + 1 * ploty
+    def coarse_to_fine_pixels(self, binary_warped, draw=True, out_img=None):
+        """
+          Lane pixels as find_lane_pixels returns them, found by sliding
+          windows on the mask reduced by coarse, then gathered at full
+          resolution within REFINE_MARGIN of a fit to the coarse pixels.
+        """
+        factor = self.coarse
+        coarse = reduce_mask(binary_warped, factor)
+        searcher = LaneLines(self._meters_per_pixel * factor,
+                             scale=self._scale / factor,
+                             nwindows=self.nwindows, margin=self.margin,
+                             minpix=self.minpix, offset=self.offset,
+                             seed_bases=self.seed_bases)
+        cleftx, clefty, crightx, crighty, coarse_img = \
+            searcher.find_lane_pixels(coarse, draw)
+
+        # coarse pixel i covers full resolution pixels factor*i onwards, so
+        # its centre is at factor*i + shift
+        shift = (factor - 1) / 2
+        height = binary_warped.shape[0]
+        ends = np.array([0.0, height / 2, height - 1])
+        margin = self._px(LaneLines.REFINE_MARGIN)
+        pixels = []
+        for x, y in ((cleftx, clefty), (crightx, crighty)):
+            fit = LaneFit(coarse.shape[0]).add(x, y).coefficients()
+            # the same quadratic in full resolution coordinates
+            fit = np.polyfit(ends, factor * np.polyval(
+                fit, (ends - shift) / factor) + shift, 2)
+            pixels.extend(band_pixels(binary_warped, fit, margin))
+        instrumentation.count('nonzero_pixels',
+                              len(pixels[0]) + len(pixels[2]))
+
+        if draw:
+            out_img = cv2.resize(coarse_img, (binary_warped.shape[1],
+                                              height), dst=out_img,
+                                 interpolation=cv2.INTER_NEAREST)
+        return tuple(pixels) + (out_img,)
+
+    def search_around_fit(self, binary_warped, draw=True, out_img=None):
+        # only the pixels of the bands within +/- margin of the prior fits
+        margin = self._px(LaneLines.SEARCH_MARGIN)
+        leftx, lefty = band_pixels(binary_warped, self._left_fit, margin)
+        rightx, righty = band_pixels(binary_warped, self._right_fit, margin)
+        instrumentation.count('nonzero_pixels', len(leftx) + len(rightx))
+        return (leftx, lefty, rightx, righty,
+                self._draw_bands(binary_warped, margin, out_img) if draw
+                else None)
+
+    def _draw_bands(self, binary_warped, margin, out_img=None):
+        out_img = gray_image(binary_warped, out_img)
+        rows = np.arange(binary_warped.shape[0])
+        for fit in (self._left_fit, self._right_fit):
+            fitx = np.polyval(fit, rows)
+            for edge in (fitx - margin, fitx + margin):
+                band = np.int_([np.transpose(np.vstack([edge, rows]))])
+                cv2.polylines(out_img, band, False, (0, 255, 0), 2)
+        return out_img
+
+    def _plausible(self, leftx, rightx, left_fit, right_fit, shape):
+        min_pixels = self._count(LaneLines.MIN_LANE_PIXELS)
+        if len(leftx) < min_pixels or len(rightx) < min_pixels:
+            return False
+        y_eval = shape[0] - 1
+        width = self._meters_per_pixel * (np.polyval(right_fit, y_eval) -
+                                          np.polyval(left_fit, y_eval))
+        return LaneLines.LANE_WIDTH_RANGE[0] < width < \
+            LaneLines.LANE_WIDTH_RANGE[1]
+
+    def lane_polygons(self, shape):
+        """
+          The lane overlay for the current fits on birds' eye images of the
+          given shape, as (points, color) pairs: float (x, y) polygon
+          vertices, with x clipped to the image width, and an RGB colour.
+          The lane is green, its left line red and its right line blue,
+          drawn in that order. Edges have a vertex every POLYGON_STEP rows
+          (at full resolution), plenty for a quadratic.
+        """
+        step = self._px(LaneLines.POLYGON_STEP)
+        ploty = np.append(np.arange(0, shape[0] - 1, step), shape[0] - 1)
+        left_fitx = np.polyval(self._left_fit, ploty)
+        right_fitx = np.polyval(self._right_fit, ploty)
+
+        def polygon(x1, x2):
+            # down one edge and back up the other
+            x = np.clip(np.concatenate((x1, x2[::-1])), 0, shape[1] - 1)
+            y = np.concatenate((ploty, ploty[::-1]))
+            return np.column_stack((x, y))
+
+        margin = self._px(5)
+        return [(polygon(left_fitx, right_fitx), (0, 255, 0)),
+                (polygon(left_fitx - margin, left_fitx + margin),
+                 (255, 0, 0)),
+                (polygon(right_fitx - margin, right_fitx + margin),
+                 (0, 0, 255))]
+
+    def _draw_lane(self, shape, lane_img=None):
+        if lane_img is None:
+            lane_img = np.zeros(shape[:2] + (3,), np.uint8)
+        else:
+            lane_img.fill(0)
+        for points, color in self.lane_polygons(shape):
+            cv2.fillPoly(lane_img, np.int_([points]), color)
+        return lane_img
+
+    def _lane_fits(self, height):
+        if self._fits is None or self._fits[0].height != height:
+            self._fits = (LaneFit(height), LaneFit(height))
+        return self._fits
+
+    def _fit(self, leftx, lefty, rightx, righty, height, carry):
+        # fit this frame's pixels, with those of earlier frames down-weighted
+        # by memory when carry is set
+        fits = self._lane_fits(height)
+        for fit in fits:
+            if carry and self.memory > 0:
+                fit.decay(self.memory)
+            else:
+                fit.reset()
+        with instrumentation.stage('polyfit'):
+            return (fits[0].add(leftx, lefty).coefficients(),
+                    fits[1].add(rightx, righty).coefficients())
+
+    def update(self, binary_warped, render=RENDER_DEBUG, pool=None):
+        bw = binary_warped
+        draw = render >= RENDER_DEBUG
+        # rendered images go into the pool's buffers, if given
+        image_shape = bw.shape[:2] + (3,)
+        window_img = (pool.buffer('window_img', image_shape)
+                      if draw and pool is not None else None)
+        tracked = self._lanes_found
+        # Obtain lane pixels, around the prior fits if they can be trusted
+        if self._lanes_found:
+            with instrumentation.stage('search_around_fit'):
+                leftx, lefty, rightx, righty, window_img = \
+                    self.search_around_fit(bw, draw, window_img)
+            min_pixels = self._count(LaneLines.MIN_LANE_PIXELS)
+            if len(leftx) >= min_pixels and len(rightx) >= min_pixels:
+                left_fit, right_fit = self._fit(leftx, lefty, rightx, righty,
+                                                bw.shape[0], carry=True)
+                self._lanes_found = self._plausible(leftx, rightx, left_fit,
+                                                    right_fit, bw.shape)
+            else:
+                self._lanes_found = False
+        if not self._lanes_found:
+            tracked = False
+            instrumentation.count('sliding_window_searches')
+            with instrumentation.stage('sliding_windows'):
+                if self.coarse > 1:
+                    leftx, lefty, rightx, righty, window_img = \
+                        self.coarse_to_fine_pixels(bw, draw, window_img)
+                else:
+                    leftx, lefty, rightx, righty, window_img = \
+                        self.find_lane_pixels(bw, draw, window_img)
+
+            # Fit a second order polynomial to each, from scratch
+            left_fit, right_fit = self._fit(leftx, lefty, rightx, righty,
+                                            bw.shape[0], carry=False)
+            self._lanes_found = self._plausible(leftx, rightx, left_fit,
+                                                right_fit, bw.shape)
+        # the last change in the fits is extrapolated only while tracking
+        self._previous_fits = ((self._left_fit, self._right_fit) if tracked
+                               else None)
+        self._left_fit = left_fit
+        self._right_fit = right_fit
 
         # Color the left and right lane regions blue and red
-        window_img[lefty, leftx] = [255, 0, 0]
-        window_img[righty, rightx] = [0, 0, 255]
-
-        margin = 5
-        left_line_window1 = np.array([np.transpose(
-                                np.vstack([left_fitx - margin, ploty]))])
-        left_line_window2 = np.array([np.flipud(np.transpose(
-                                np.vstack([left_fitx + margin, ploty])))])
-        left_line_pts = np.hstack((left_line_window1, left_line_window2))
-        right_line_window1 = np.array([np.transpose(
-                                    np.vstack([right_fitx - margin, ploty]))])
-        right_line_window2 = np.array([np.flipud(np.transpose(np.vstack(
-                                           [right_fitx + margin, ploty])))])
-        right_line_pts = np.hstack((right_line_window1, right_line_window2))
-
-        pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
-        pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx,
-                                                                ploty])))])
-        pts = np.hstack((pts_left, pts_right))
-
-        lane_img = np.zeros_like(window_img)
-        # lane centre green
-        cv2.fillPoly(lane_img, np.int_([pts]), (0, 255, 0))
-        # left lane line red
-        cv2.fillPoly(lane_img, np.int_([left_line_pts]), (255, 0, 0))
-        # right lane line blue
-        cv2.fillPoly(lane_img, np.int_([right_line_pts]), (0, 0, 255))
-
-        # calculate radius of curvature
-        mpp = self._meters_per_pixel
-        y_eval = np.max(ploty)
-        left_fit_cr = np.polyfit(mpp * ploty, mpp * left_fitx, 2)
-        left_radius_of_curvature = (((1 + (2 * left_fit_cr[0] * y_eval*mpp +
-                                    left_fit_cr[1]) ** 2) ** 1.5) /
-                                    np.absolute(2 * left_fit_cr[0]))
+        if draw:
+            window_img[lefty, leftx] = [255, 0, 0]
+            window_img[righty, rightx] = [0, 0, 255]
 
-        # calculate vehicle displacement from lane centre
-        displacement = mpp * ((bw.shape[1] / 2) -
-                              ((left_fitx[-1] + right_fitx[-1]) / 2))
+        lane_img = None
+        if render >= RENDER_LANE:
+            with instrumentation.stage('fillPoly'):
+                lane_img = self._draw_lane(
+                    bw.shape, pool.buffer('lane_img', image_shape)
+                    if pool is not None else None)
 
+        left_radius_of_curvature, displacement = self._measure(bw.shape)
         return lane_img, left_radius_of_curvature, displacement, window_img
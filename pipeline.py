@@ -3,88 +3,441 @@
 from camera_calibration import *
 from birdseye_transform import *
 from lane_lines import *
+from frame_stream import *
+import instrumentation
+import os
+import time
+from scheduler import AdaptiveScheduler
+from frame_store import FrameStore
+from camera_registry import CameraRegistry
+from buffer_pool import BufferPool
+from concurrent.futures import ProcessPoolExecutor
 from moviepy.editor import VideoFileClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 
 
 test_glob = 'test_images/*.jpg'
 # test_glob = 'video_images/*.jpg'
+cache_dir = 'cache'
 
 
-c = CameraCalibration('camera_cal/calibration*.jpg')
-t = BirdsEyeTransform(c, 'test_images/straight_lines*jpg')
-
-
-def process_image(image, fname=None, out_dir=None):
-    undistorted = c.undistort(image)
-    hls = cv2.cvtColor(undistorted, cv2.COLOR_RGB2HLS)
-    gray = cv2.cvtColor(undistorted, cv2.COLOR_RGB2GRAY)
-
-    s_thresh = (170, 255)
-    s_channel = hls[:, :, 2]
-    s_binary = np.zeros_like(s_channel)
-    s_binary[(s_channel >= s_thresh[0]) & (s_channel <= s_thresh[1])] = 1
-
-    sx_thresh = (20, 100)
-    sobel_sx = cv2.Sobel(s_channel, cv2.CV_64F, 1, 0)
-    abs_sobel_sx = np.absolute(sobel_sx)
-    scaled_sobel_sx = np.uint8(255 * abs_sobel_sx / np.max(abs_sobel_sx))
-    sx_binary = np.zeros_like(scaled_sobel_sx)
-    sx_binary[(scaled_sobel_sx >= sx_thresh[0]) &
-              (scaled_sobel_sx <= sx_thresh[1])] = 1
-
-    x_thresh = (20, 100)
-    gray = cv2.cvtColor(undistorted, cv2.COLOR_RGB2GRAY)
-    sobel_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0)
-    abs_sobel_x = np.absolute(sobel_x)
-    scaled_sobel_x = np.uint8(255 * abs_sobel_x / np.max(abs_sobel_x))
-    x_binary = np.zeros_like(scaled_sobel_x)
-    x_binary[(scaled_sobel_x >= x_thresh[0]) &
-             (scaled_sobel_x <= x_thresh[1])] = 1
-
-    combined_binary = np.zeros_like(s_binary)
-    combined_binary[(s_binary == 1) | (sx_binary == 1) | (x_binary == 1)] = 1
-    combined_binary_t = t.transform(combined_binary)
-
-    ll = LaneLines(t.meters_per_pixel)
-    lane, left_curverad, displacement, windows = ll.update(combined_binary_t)
-    lane_u = t.untransform(lane)
-
-    annotated_img = cv2.addWeighted(undistorted, 1, lane_u, 0.3, 0)
-    rc_text = "Radius of Curvature = {0: >5.0f}m".format(left_curverad)
-    cv2.putText(annotated_img, rc_text, (50, 50), cv2.FONT_HERSHEY_TRIPLEX,
-                1, (255, 255, 255), 2)
-    direction = "right" if displacement >= 0 else "left"
-    disp_text = "Vehicle is {0:.2f}m {1} of center".format(abs(displacement),
-                                                           direction)
-    cv2.putText(annotated_img, disp_text, (50, 100), cv2.FONT_HERSHEY_TRIPLEX,
-                1, (255, 255, 255), 2)
+threshold = LaneThreshold(s_thresh=(170, 255), sx_thresh=(20, 100),
+                          x_thresh=(20, 100))
+# in warp-first mode, raw frames are warped to a reduced resolution birds'
+# eye view before thresholding
+warped_scale = 0.5
+
+# calibration and transforms per camera, loaded on first use; functions
+# taking a camera ID use default_camera when it is None
+cameras = CameraRegistry(cache_dir=cache_dir, warped_scale=warped_scale)
+default_camera = 'project'
+cameras.register(default_camera, 'camera_cal/calibration*.jpg',
+                 'test_images/straight_lines*jpg')
+
+
+def camera_for(camera=None):
+    """
+      (calibration, transform, warp-first transform) of a camera ID.
+    """
+    return cameras[default_camera if camera is None else camera]
+
+
+def load_camera(camera=None, shape=None, warp_first=False):
+    """
+      Load a camera now rather than on first use, and given a frame shape,
+      build the remap tables process_image uses for frames of that shape,
+      e.g. before forking workers so that they inherit them.
+    """
+    c, t, tw = camera_for(camera)
+    if shape is not None:
+        c.undistort_maps(shape)
+        if warp_first:
+            tw.raw_maps(shape)
+        else:
+            t.cropped_warp_maps(shape)
+    return c, t, tw
+
+
+def __getattr__(name):
+    # the default camera's c (calibration), t (transform) and tw (warp-first
+    # transform), as module attributes
+    fields = {'c': 'calibration', 't': 'transform', 'tw': 'warped_transform'}
+    if name not in fields:
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+    return getattr(camera_for(), fields[name])
+
+
+def new_lane_lines(warp_first=False, camera=None, coarse=1):
+    # coarse = 2 or 4 for coarse-to-fine lane detection (see LaneLines)
+    _, t, tw = camera_for(camera)
+    lt = tw if warp_first else t
+    return LaneLines(lt.meters_per_pixel, scale=lt.scale, coarse=coarse)
+
+
+def _buffer(pool, name, shape):
+    # a named scratch array of a BufferPool, or None to allocate one
+    return pool.buffer(name, shape) if pool is not None else None
+
+
+def _output(pool, shape):
+    return pool.output(shape) if pool is not None else None
+
+
+def warped_binary(image, warp_first=False, full_frame=True, camera=None,
+                  thresh=None, pool=None):
+    """
+      The thresholded birds' eye view of a camera frame, and the undistorted
+      frame when it was computed along the way (None in warp-first mode).
+      Only the region the birds' eye transform samples is thresholded, so
+      gradients are scaled by the largest within that region rather than
+      the whole frame's; with full_frame=False only that region is
+      undistorted either, and None is returned for the undistorted frame.
+      thresh replaces the module's threshold, e.g. with one LaneThreshold
+      per thread. With a BufferPool, every array is written into the pool's
+      buffers, and the undistorted frame into its next output.
+    """
+    c, t, tw = camera_for(camera)
+    thresh = thresh if thresh is not None else threshold
+    if warp_first:
+        with instrumentation.stage('warp'):
+            warped = tw.transform_raw(image, dst=_buffer(
+                pool, 'warped', tw.warped_shape(image.shape) +
+                image.shape[2:]))
+        return thresh.apply(warped, out=_buffer(pool, 'binary_warped',
+                                                warped.shape[:2])), None
+    x0, y0, x1, y1 = box = t.source_box(image.shape)
+    with instrumentation.stage('undistort'):
+        if full_frame:
+            undistorted = c.undistort(image, dst=_output(pool, image.shape))
+            region = undistorted[y0:y1, x0:x1]
+        else:
+            undistorted = None
+            region = c.undistort(image, box=box, dst=_buffer(
+                pool, 'region', (y1 - y0, x1 - x0) + image.shape[2:]))
+    combined_binary = thresh.apply(region, out=_buffer(pool, 'binary',
+                                                       region.shape[:2]))
+    with instrumentation.stage('warp'):
+        return (t.transform_cropped(combined_binary, image.shape,
+                                    dst=_buffer(pool, 'binary_t',
+                                                t.warped_shape(image.shape))),
+                undistorted)
+
+
+def detect_lanes(image, lane_lines=None, warp_first=False, camera=None,
+                 pool=None):
+    """
+      Lane fits (in birds' eye pixels), radius of curvature and displacement
+      of one camera frame, without drawing anything:
+      left_fit, right_fit, curvature, displacement = detect_lanes(image, ll)
+    """
+    combined_binary_t, _ = warped_binary(image, warp_first,
+                                         full_frame=False, camera=camera,
+                                         pool=pool)
+    ll = (lane_lines if lane_lines is not None
+          else new_lane_lines(warp_first, camera))
+    _, left_curverad, displacement, _ = ll.update(combined_binary_t,
+                                                  render=RENDER_NONE)
+    return ll.left_fit, ll.right_fit, left_curverad, displacement
+
+
+def annotate(frame, polygons, left_curverad, displacement, lt, pool=None):
+    """
+      Overlay the lane, given as birds' eye polygons from
+      LaneLines.lane_polygons and projected into the frame by the transform
+      lt, and the curvature and displacement on an undistorted frame, in
+      place. Only the lane's bounding box is blended.
+    """
+    with instrumentation.stage('overlay'):
+        overlay_polygons(frame, [(lt.untransform_points(points), color)
+                                 for points, color in polygons],
+                         scratch=_buffer(pool, 'overlay', frame.shape))
+    with instrumentation.stage('putText'):
+        rc_text = "Radius of Curvature = {0: >5.0f}m".format(left_curverad)
+        cv2.putText(frame, rc_text, (50, 50),
+                    cv2.FONT_HERSHEY_TRIPLEX, 1, (255, 255, 255), 2)
+        direction = "right" if displacement >= 0 else "left"
+        disp_text = "Vehicle is {0:.2f}m {1} of center".format(
+            abs(displacement), direction)
+        cv2.putText(frame, disp_text, (50, 100),
+                    cv2.FONT_HERSHEY_TRIPLEX, 1, (255, 255, 255), 2)
+    return frame
+
+
+def process_batch(frames, lane_lines=None, warp_first=False, workers=None,
+                  out=None, camera=None):
+    """
+      Annotate a batch of consecutive frames of one stream (an (N, H, W, 3)
+      array or a list of frames of one shape) into out, allocated if not
+      given, as process_image would one at a time. Undistortion,
+      thresholding, warping and annotation run across workers threads, with
+      shared remap tables; only lane tracking runs frame by frame, in order.
+    """
+    c, t, tw = camera_for(camera)
+    lt = tw if warp_first else t
+    # frames are annotated in place, once undistorted into out
+    undistorted = c.undistort_batch(frames, out=out, workers=workers)
+
+    def new_threshold():
+        return LaneThreshold(threshold.s_thresh, threshold.sx_thresh,
+                             threshold.x_thresh)
+
+    if warp_first:
+        warped = tw.transform_raw_batch(frames, workers=workers)
+        binaries = output_buffer(None, len(frames), warped.shape[1:3],
+                                 np.uint8)
+        map_batch(lambda image, dst, thresh: thresh.apply(image, out=dst),
+                  warped, binaries, workers, make_state=new_threshold)
+    else:
+        shape = undistorted.shape[1:]
+        x0, y0, x1, y1 = t.source_box(shape)
+        binaries = output_buffer(None, len(frames), t.warped_shape(shape),
+                                 np.uint8)
+        map_batch(lambda image, dst, thresh: t.transform_cropped(
+                      thresh.apply(image[y0:y1, x0:x1]), shape, dst=dst),
+                  undistorted, binaries, workers, make_state=new_threshold)
+
+    ll = (lane_lines if lane_lines is not None
+          else new_lane_lines(warp_first, camera))
+    results = []
+    for binary in binaries:
+        _, left_curverad, displacement, _ = ll.update(binary,
+                                                      render=RENDER_NONE)
+        results.append((ll.lane_polygons(binary.shape), left_curverad,
+                        displacement))
+
+    return map_batch(lambda i, frame: annotate(frame, *results[i], lt),
+                     np.arange(len(frames)), undistorted, workers)
+
+
+def process_image(image, fname=None, out_dir=None, lane_lines=None,
+                  warp_first=False, camera=None, pool=None):
+    """
+      Annotate one camera frame with the detected lane. Pass a persistent
+      LaneLines (from new_lane_lines) as lane_lines to track the lane across
+      frames of a stream; otherwise each call detects from scratch.
+      With warp_first, the frame is warped to birds' eye view at
+      warped_scale first, so thresholds only run on pixels LaneLines uses.
+      Intermediate images are only rendered when fname is given, in which
+      case they are saved to out_dir. camera is the ID of the camera the
+      frame is from (see cameras), the default camera if None; a stream's
+      LaneLines must come from new_lane_lines for the same camera.
+      With a stream's BufferPool as pool, no full frame arrays are
+      allocated once the pool has seen a frame, and the annotated frame is
+      the pool's next output.
+    """
+    c, t, tw = camera_for(camera)
+    lt = tw if warp_first else t
+    combined_binary_t, undistorted = warped_binary(image, warp_first,
+                                                   camera=camera, pool=pool)
+    if undistorted is None:
+        with instrumentation.stage('undistort'):
+            undistorted = c.undistort(image, dst=_output(pool, image.shape))
+
+    ll = (lane_lines if lane_lines is not None
+          else new_lane_lines(warp_first, camera))
+    render = RENDER_DEBUG if fname is not None else RENDER_NONE
+    lane, left_curverad, displacement, windows = ll.update(combined_binary_t,
+                                                           render=render,
+                                                           pool=pool)
+    annotated_img = annotate(undistorted,
+                             ll.lane_polygons(combined_binary_t.shape),
+                             left_curverad, displacement, lt, pool)
 
     if fname is not None:
         name = fname.split('/')[-1][:-4]
         out_dir = out_dir + "/"
-        color_binary = np.dstack((x_binary, sx_binary, s_binary)) * 255
-        color_binary_t = t.transform(color_binary)
+        color_binary = np.dstack((threshold.x_binary, threshold.sx_binary,
+                                  threshold.s_binary))
+        color_binary_t = (color_binary if warp_first
+                          else t.transform_cropped(color_binary,
+                                                   image.shape))
         mpimg.imsave(out_dir + name + "_activated_pixels.jpg", color_binary_t)
         mpimg.imsave(out_dir + name + "_lboxed.jpg", windows)
         mpimg.imsave(out_dir + name + "_lined.jpg", lane)
-        transformed = t.transform(undistorted)
+        transformed = lt.transform_raw(image)
         mpimg.imsave(out_dir + name + "_trans.jpg", transformed)
         mpimg.imsave(out_dir + name + "_anotated.jpg", annotated_img)
     return annotated_img
 
 
-def annotate_files(in_glob, out_dir):
+class AdaptiveProcessor:
+    """
+      Annotates the frames of a live stream within a per-frame deadline (in
+      seconds), degrading when frames run late and recovering when load
+      falls, as chosen by an AdaptiveScheduler over LEVELS:
+      0: process_image at full resolution
+      1: process_image in warp-first mode, at warped_scale
+      2, 3: as 1, but lanes are only detected on every second (third) frame;
+         other frames extrapolate the last fits (LaneLines.extrapolate)
+      process = AdaptiveProcessor(deadline=1/25., camera='front')
+      stream(video_frames(0), process, sink, maxsize=process.maxsize)
+      process.scheduler.report()  # including how many frames were degraded
+      Frames are processed in a BufferPool with as many annotated frames as
+      stream holds at once for the given maxsize; the stream must be given
+      the same maxsize, or frames still queued for its sink are overwritten.
+    """
+    # (warp_first, detect lanes on every nth frame) per level
+    LEVELS = [(False, 1), (True, 1), (True, 2), (True, 3)]
+
+    def __init__(self, deadline, camera=None, maxsize=4, **scheduler_args):
+        self.scheduler = AdaptiveScheduler(deadline, len(self.LEVELS),
+                                           **scheduler_args)
+        self.camera = camera
+        self.maxsize = maxsize
+        self.pool = BufferPool(frames_in_flight(maxsize))
+        self.skipped_detections = 0
+        self._lane_lines = {False: new_lane_lines(False, camera),
+                            True: new_lane_lines(True, camera)}
+        self._warp_first = False
+        self._frame = 0
+        # warp modes whose lookup tables have been built
+        self._warmed = set()
+
+    def __call__(self, image):
+        start = time.perf_counter()
+        warp_first, detect_every = self.LEVELS[self.scheduler.level]
+        ll = self._lane_lines[warp_first]
+        if warp_first != self._warp_first:
+            ll.follow(self._lane_lines[self._warp_first])
+            self._warp_first = warp_first
+        self._frame += 1
+        if self._frame % detect_every and ll.left_fit is not None:
+            c, t, tw = camera_for(self.camera)
+            lt = tw if warp_first else t
+            with instrumentation.stage('undistort'):
+                undistorted = c.undistort(image,
+                                          dst=self.pool.output(image.shape))
+            shape = lt.warped_shape(image.shape)
+            left_curverad, displacement = ll.extrapolate(shape)
+            annotated_img = annotate(undistorted, ll.lane_polygons(shape),
+                                     left_curverad, displacement, lt,
+                                     self.pool)
+            self.skipped_detections += 1
+        else:
+            annotated_img = process_image(image, lane_lines=ll,
+                                          warp_first=warp_first,
+                                          camera=self.camera, pool=self.pool)
+        if warp_first in self._warmed:
+            self.scheduler.record(time.perf_counter() - start)
+        else:
+            self._warmed.add(warp_first)
+            self.scheduler.record(None)
+        return annotated_img
+
+
+def annotate_chunk(fname, start, stop, warmup=0, warp_first=False,
+                   camera=None):
+    """
+      Annotated frames start..stop-1 of a video, tracked with a LaneLines of
+      their own. The tracker is first run over up to warmup frames before
+      start, so that it enters the chunk in the state a serial run would.
+    """
+    clip = VideoFileClip(fname, audio=False)
+    ll = new_lane_lines(warp_first, camera)
+    annotated = []
+    try:
+        for i in range(max(0, start - warmup), stop):
+            frame = clip.get_frame(i / clip.fps)
+            if i < start:
+                process_image(frame, lane_lines=ll, warp_first=warp_first,
+                              camera=camera)
+            else:
+                annotated.append(process_image(frame, lane_lines=ll,
+                                               warp_first=warp_first,
+                                               camera=camera))
+    finally:
+        clip.close()
+    return annotated
+
+
+def annotate_video_parallel(fname, outputf, workers=None, chunk_frames=50,
+                            warmup=5, warp_first=False, camera=None):
+    """
+      Annotate a video across a pool of worker processes. Each worker decodes
+      and annotates a chunk of consecutive frames (see annotate_chunk), and
+      chunks are written to outputf in order, with at most two chunks per
+      worker in flight. Workers share the module level camera registry:
+      forked workers inherit the cameras loaded so far, spawned ones load
+      them from cache_dir (and know only cameras registered at import).
+      The camera and its remap tables for the clip's frame size are loaded
+      here first, so that forked workers do not each load or calibrate it.
+    """
+    workers = workers or os.cpu_count()
+    clip = VideoFileClip(fname, audio=False)
+    fps, size = clip.fps, clip.size
+    # the frame times clip.iter_frames would visit
+    nframes = len(np.arange(0, clip.duration, 1.0 / fps))
+    clip.close()
+    load_camera(camera, (size[1], size[0], 3), warp_first)
+    chunks = [(start, min(start + chunk_frames, nframes))
+              for start in range(0, nframes, chunk_frames)]
+    # the pool is shut down before the writer closes: forked workers hold
+    # the encoder's input pipe open until they exit
+    with FFMPEG_VideoWriter(outputf, size, fps) as writer, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        max_pending = 2 * workers
+        pending = []
+        for start, stop in chunks:
+            pending.append(pool.submit(annotate_chunk, fname, start, stop,
+                                       warmup, warp_first, camera))
+            if len(pending) >= max_pending:
+                for frame in pending.pop(0).result():
+                    writer.write_frame(frame)
+        for future in pending:
+            for frame in future.result():
+                writer.write_frame(frame)
+
+
+def annotate_files(in_glob, out_dir, warp_first=False, workers=None,
+                   deadline=None, camera=None, maxsize=4):
+    """
+      Annotate the images, mp4 videos and .npy frame stores matching in_glob
+      into out_dir. Videos are annotated across workers processes if given,
+      or else streamed, as are frame stores, with lane tracking and one
+      image per frame named by the store index; with a deadline (seconds per
+      frame), through an AdaptiveProcessor, reporting how many frames were
+      degraded. All files are taken to be from the given camera. Streams
+      buffer up to maxsize frames either side of processing.
+    """
     for fname in glob.glob(in_glob):
-        if '.mp4' == fname[-4:]:
-            clip = VideoFileClip(fname)
-            outputf = out_dir + "/" + fname
-            try:
-                clip = clip.fl_image(process_image)
-                clip.write_videofile(outputf, audio=False)
-            except Exception:
-                pass
+        if fname[-4:] in ('.mp4', '.npy'):
+            if fname[-4:] == '.mp4':
+                outputf = out_dir + "/" + fname
+                if workers is not None:
+                    annotate_video_parallel(fname, outputf, workers=workers,
+                                            warp_first=warp_first,
+                                            camera=camera)
+                    continue
+                frames = video_frames(fname)
+                sink = VideoSink(outputf, video_fps(fname))
+            else:
+                store = FrameStore.open(fname)
+                os.makedirs(out_dir, exist_ok=True)
+                frames = store.frames
+                sink = ImageSink(out_dir, '{}.jpg', names=store.names)
+            if deadline is not None:
+                process = AdaptiveProcessor(deadline, camera=camera,
+                                            maxsize=maxsize)
+            else:
+                ll = new_lane_lines(warp_first, camera)
+                # as many outputs as the stream below holds at once
+                pool = BufferPool(frames_in_flight(maxsize))
+
+                def process(image):
+                    return process_image(image, lane_lines=ll,
+                                         warp_first=warp_first,
+                                         camera=camera, pool=pool)
+            stream(frames, process, sink, maxsize)
+            if deadline is not None:
+                report = process.scheduler.report()
+                print("{}: {} of {} frames degraded, {} detections "
+                      "skipped".format(fname, report['degraded_frames'],
+                                       report['frames'],
+                                       process.skipped_detections))
         else:
-            process_image(mpimg.imread(fname), fname=fname, out_dir=out_dir)
+            process_image(mpimg.imread(fname), fname=fname, out_dir=out_dir,
+                          warp_first=warp_first, camera=camera)
 
 
 if __name__ == "__main__":
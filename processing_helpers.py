@@ -1,68 +1,200 @@
+import functools
 import numpy as np
 import cv2
+import instrumentation
 
 
 def region_of_interest(img, vertices):
-    mask = np.zeros_like(img)
-    if len(img.shape) > 2:
-        channel_count = img.shape[2]
+    masked_image = cv2.bitwise_and(img, roi_mask(img.shape, img.dtype,
+                                                 vertices))
+    return masked_image
+
+
+def roi_mask(shape, dtype, vertices):
+    """
+      Read-only mask of the given shape and dtype, filled (with the maximum
+      value of a uint8) inside the polygons given by vertices. Masks are
+      cached, so repeated calls for one region share a single mask.
+    """
+    vertices = np.asarray(vertices, np.int32)
+    return _roi_mask(tuple(shape), np.dtype(dtype).str, vertices.tobytes(),
+                     vertices.shape)
+
+
+@functools.lru_cache(maxsize=16)
+def _roi_mask(shape, dtype, vertices, vertices_shape):
+    mask = np.zeros(shape, dtype)
+    if len(shape) > 2:
+        channel_count = shape[2]
         ignore_mask_color = (255,) * channel_count
     else:
         ignore_mask_color = 255
-    cv2.fillPoly(mask, vertices, ignore_mask_color)
-    masked_image = cv2.bitwise_and(img, mask)
-    return masked_image
+    cv2.fillPoly(mask, np.frombuffer(vertices, np.int32).reshape(
+        vertices_shape), ignore_mask_color)
+    mask.flags.writeable = False
+    return mask
 
 
 def s_filter(in_img, s_thresh_min=80, s_thresh_max=255):
     hls = cv2.cvtColor(in_img, cv2.COLOR_RGB2HLS)
-    s_channel = hls[:, :, 2]
-    s_binary = np.zeros_like(s_channel)
-    s_binary[(s_channel >= s_thresh_min) & (s_channel <= s_thresh_max)] = 1
-    return s_binary
+    return to_binary(cv2.inRange(hls[:, :, 2], s_thresh_min, s_thresh_max))
 
 
 def h_filter(in_img, h_thresh_min=15, h_thresh_max=100):
     hls = cv2.cvtColor(in_img, cv2.COLOR_RGB2HLS)
-    h_channel = hls[:, :, 0]
-    h_binary = np.zeros_like(h_channel)
-    h_binary[(h_channel >= h_thresh_min) & (h_channel <= h_thresh_max)] = 1
-    return h_binary
+    return to_binary(cv2.inRange(hls[:, :, 0], h_thresh_min, h_thresh_max))
 
 
 def sobel_x_filter(in_img, thresh_min=20, thresh_max=100):
     gray = cv2.cvtColor(in_img, cv2.COLOR_RGB2GRAY)
-    sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0)  # Take the derivative in x
-    # Absolute x derivative to accentuate lines away from horizontal
-    abs_sobelx = np.absolute(sobelx)
-    scaled_sobel = np.uint8(255*abs_sobelx/np.max(abs_sobelx))
-    sxbinary = np.zeros_like(scaled_sobel)
-    sxbinary[(scaled_sobel >= thresh_min) & (scaled_sobel <= thresh_max)] = 1
-    return sxbinary
+    return to_binary(sobel_x_mask(gray, thresh_min, thresh_max))
 
 
 def sobel_xs_filter(in_img, thresh_min=32, thresh_max=200):
     hls = cv2.cvtColor(in_img, cv2.COLOR_RGB2HLS)
-    s_channel = hls[:, :, 2]
-    sobelx = cv2.Sobel(s_channel, cv2.CV_64F, 1, 0)  # Take the derivative in x
-    # Absolute x derivative to accentuate lines away from horizontal
-    abs_sobelx = np.absolute(sobelx)
-    scaled_sobel = np.uint8(255*abs_sobelx/np.max(abs_sobelx))
-    sxbinary = np.zeros_like(scaled_sobel)
-    sxbinary[(scaled_sobel >= thresh_min) & (scaled_sobel <= thresh_max)] = 1
-    return sxbinary
+    s_channel = cv2.extractChannel(hls, 2)
+    return to_binary(sobel_x_mask(s_channel, thresh_min, thresh_max))
 
 
 def sobel_xh_filter(in_img, thresh_min=32, thresh_max=200):
     hls = cv2.cvtColor(in_img, cv2.COLOR_RGB2HLS)
-    h_channel = hls[:, :, 0]
-    sobelx = cv2.Sobel(h_channel, cv2.CV_64F, 1, 0)  # Take the derivative in x
+    h_channel = cv2.extractChannel(hls, 0)
+    return to_binary(sobel_x_mask(h_channel, thresh_min, thresh_max))
+
+
+def to_binary(mask):
+    # 0/255 mask to 0/1, in place
+    return cv2.bitwise_and(mask, 1, dst=mask)
+
+
+def sobel_x_mask(channel, thresh_min, thresh_max, dst=None, sobel=None):
+    """
+      255 where the absolute x derivative of a uint8 channel, scaled so that
+      the largest in the image is 255, is within [thresh_min, thresh_max].
+      sobel is an optional int16 scratch buffer.
+    """
+    return scaled_threshold(abs_sobel_x(channel, dst=sobel), thresh_min,
+                            thresh_max, dst=dst)
+
+
+def abs_sobel_x(channel, dst=None):
+    # exact for uint8 channels: at most 4*255 in magnitude
+    sobel = cv2.Sobel(channel, cv2.CV_16S, 1, 0, dst=dst)
     # Absolute x derivative to accentuate lines away from horizontal
-    abs_sobelx = np.absolute(sobelx)
-    scaled_sobel = np.uint8(255*abs_sobelx/np.max(abs_sobelx))
-    sxbinary = np.zeros_like(scaled_sobel)
-    sxbinary[(scaled_sobel >= thresh_min) & (scaled_sobel <= thresh_max)] = 1
-    return sxbinary
+    return np.abs(sobel, out=sobel)
+
+
+def scaled_threshold(abs_sobel, thresh_min, thresh_max, dst=None):
+    """
+      255 where abs_sobel, scaled so that its maximum is 255, is within
+      [thresh_min, thresh_max]. The thresholds are moved onto the unscaled
+      values instead of building a scaled copy.
+    """
+    max_sobel = int(cv2.minMaxLoc(abs_sobel)[1])
+    if max_sobel == 0:
+        return cv2.inRange(abs_sobel, 1, 0, dst=dst)
+    # uint8(255*a/max) >= lo  <=>  255*a >= lo*max
+    # uint8(255*a/max) <= hi  <=>  255*a < (hi+1)*max
+    low = -(-thresh_min * max_sobel // 255)
+    high = ((thresh_max + 1) * max_sobel - 1) // 255
+    return cv2.inRange(abs_sobel, low, high, dst=dst)
+
+
+class LaneThreshold:
+    """
+      Combined binary thresholding of RGB frames: HLS saturation, x gradient
+      of saturation and x gradient of gray, as used by the lane pipeline.
+      Each colour conversion and gradient is computed once per frame, into
+      scratch buffers reused across frames of the same size.
+      thresh = LaneThreshold()
+      binary = thresh.apply(image)  # 1 where any threshold is met, else 0
+      The component masks (0 or 255) of the last frame are available as
+      thresh.s_binary, thresh.sx_binary and thresh.x_binary.
+    """
+    s_binary = None
+    sx_binary = None
+    x_binary = None
+
+    def __init__(self, s_thresh=(170, 255), sx_thresh=(20, 100),
+                 x_thresh=(20, 100)):
+        self.s_thresh = s_thresh
+        self.sx_thresh = sx_thresh
+        self.x_thresh = x_thresh
+        self._shape = None
+
+    def _allocate(self, shape):
+        h, w = shape[0], shape[1]
+        self._hls = np.empty((h, w, 3), np.uint8)
+        self._gray = np.empty((h, w), np.uint8)
+        self._s_channel = np.empty((h, w), np.uint8)
+        self._sobel_s = np.empty((h, w), np.int16)
+        self._sobel_gray = np.empty((h, w), np.int16)
+        self.s_binary = np.empty((h, w), np.uint8)
+        self.sx_binary = np.empty((h, w), np.uint8)
+        self.x_binary = np.empty((h, w), np.uint8)
+        self._shape = shape[:2]
+
+    def channels(self, image):
+        """
+          The S channel of an RGB frame and the absolute x gradients of its
+          S channel and of its gray level, in scratch buffers overwritten by
+          the next frame: the intermediates all thresholds are applied to.
+        """
+        if self._shape != image.shape[:2]:
+            self._allocate(image.shape)
+        with instrumentation.stage('color_conversion'):
+            hls = cv2.cvtColor(image, cv2.COLOR_RGB2HLS, dst=self._hls)
+            s_channel = cv2.extractChannel(hls, 2, dst=self._s_channel)
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=self._gray)
+
+        with instrumentation.stage('sobel'):
+            sobel_s = abs_sobel_x(s_channel, dst=self._sobel_s)
+            sobel_gray = abs_sobel_x(gray, dst=self._sobel_gray)
+        return s_channel, sobel_s, sobel_gray
+
+    def apply(self, image, out=None):
+        s_channel, sobel_s, sobel_gray = self.channels(image)
+
+        with instrumentation.stage('threshold'):
+            cv2.inRange(s_channel, self.s_thresh[0], self.s_thresh[1],
+                        dst=self.s_binary)
+            scaled_threshold(sobel_s, self.sx_thresh[0], self.sx_thresh[1],
+                             dst=self.sx_binary)
+            scaled_threshold(sobel_gray, self.x_thresh[0], self.x_thresh[1],
+                             dst=self.x_binary)
+
+            out = cv2.bitwise_or(self.s_binary, self.sx_binary, dst=out)
+            cv2.bitwise_or(out, self.x_binary, dst=out)
+            return to_binary(out)
+
+
+def overlay_polygons(image, polygons, alpha=0.3, shift=4, scratch=None):
+    """
+      Blend filled polygons, given as (points, color) pairs with float (x, y)
+      vertices, into image in place: image + alpha*color inside them, with
+      later polygons drawn over earlier ones. Equivalent to addWeighted with
+      a full frame overlay, but only the polygons' bounding box is touched.
+      Vertices are rasterized with shift fractional bits. scratch, an array
+      like image, holds the overlay instead of a new one.
+    """
+    h, w = image.shape[:2]
+    points = [np.asarray(p, np.float64).reshape(-1, 2) for p, _ in polygons]
+    corners = np.concatenate(points)
+    x0, y0 = np.maximum(np.floor(corners.min(axis=0)), 0).astype(int)
+    x1, y1 = np.minimum(np.ceil(corners.max(axis=0)) + 1, (w, h)).astype(int)
+    if x0 >= x1 or y0 >= y1:
+        return image
+    roi = image[y0:y1, x0:x1]
+    if scratch is None:
+        overlay = np.zeros_like(roi)
+    else:
+        overlay = scratch[y0:y1, x0:x1]
+        overlay.fill(0)
+    for p, (_, color) in zip(points, polygons):
+        fixed = np.round((p - (x0, y0)) * (1 << shift)).astype(np.int32)
+        cv2.fillPoly(overlay, [fixed], color, shift=shift)
+    cv2.addWeighted(roi, 1, overlay, alpha, 0, dst=roi)
+    return image
 
 
 def draw_lines(img, lines, color=[255, 0, 0], thickness=5):
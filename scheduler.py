@@ -0,0 +1,79 @@
+"""
+  Latency driven choice of processing quality for live streams. A scheduler
+  picks a level for each frame, from 0 (full quality) up to levels - 1
+  (cheapest), given how long frames at each level have been taking against
+  a per-frame deadline. E.g.
+  s = AdaptiveScheduler(deadline=1/25., levels=4)
+  for frame in frames:
+      start = time.perf_counter()
+      process(frame, s.level)
+      s.record(time.perf_counter() - start)
+  s.report()  # frames, degraded frames and frames per level
+"""
+
+
+class AdaptiveScheduler:
+    """
+      Moves one level down in quality as soon as the smoothed latency of the
+      current level exceeds the deadline. Once the current level has stayed
+      within headroom*deadline for patience frames, the next level up is
+      tried again, starting from an estimate of headroom*deadline, so it is
+      abandoned quickly if it is still too slow.
+    """
+    def __init__(self, deadline, levels, smoothing=0.3, headroom=0.8,
+                 patience=25):
+        if levels < 1:
+            raise ValueError("A scheduler needs at least one level")
+        self.deadline = deadline
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.patience = patience
+        self.level = 0
+        self.level_counts = [0] * levels
+        self._estimates = [None] * levels
+        self._comfortable = 0
+
+    @property
+    def frames(self):
+        return sum(self.level_counts)
+
+    @property
+    def degraded_frames(self):
+        # frames processed below full quality
+        return self.frames - self.level_counts[0]
+
+    def record(self, seconds):
+        """
+          Account for a frame processed at the current level in seconds, and
+          choose the level of the next frame. seconds may be None for a frame
+          whose latency is not representative, e.g. one that built lookup
+          tables, which is counted but does not affect the level.
+        """
+        level = self.level
+        self.level_counts[level] += 1
+        if seconds is None:
+            return
+        estimate = self._estimates[level]
+        if estimate is None:
+            estimate = seconds
+        else:
+            estimate += self.smoothing * (seconds - estimate)
+        self._estimates[level] = estimate
+
+        if estimate > self.deadline:
+            self._comfortable = 0
+            if level < len(self.level_counts) - 1:
+                self.level = level + 1
+        elif level > 0 and estimate < self.headroom * self.deadline:
+            self._comfortable += 1
+            if self._comfortable >= self.patience:
+                self._comfortable = 0
+                self.level = level - 1
+                self._estimates[level - 1] = self.headroom * self.deadline
+        else:
+            self._comfortable = 0
+
+    def report(self):
+        return {'frames': self.frames,
+                'degraded_frames': self.degraded_frames,
+                'level_counts': list(self.level_counts)}
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+
+"""
+  Lane detection as a local service: HTTP/1.1 over TCP or a Unix socket,
+  served with asyncio from the standard library. E.g.
+  ./server.py --port 8080
+  ./server.py --unix /tmp/lanes.sock
+  Requests:
+  POST /streams/<stream_id>/frames[?annotate=1&camera=<id>&warp_first=1]
+    The body is an encoded image (Content-Type image/jpeg or image/png), a
+    .npy array (application/x-npy) or raw RGB bytes
+    (application/octet-stream) with an X-Frame-Shape: height,width,3
+    header. The JSON response holds the frame's index in its stream, the
+    lane fits, curvature, displacement, whether a plausible lane was found
+    and the latency; with annotate, also the annotated frame as a base64
+    JPEG. A stream's camera and warp mode are set by its first frame.
+  DELETE /streams/<stream_id>  forget a stream and its lane tracking state
+  GET /metrics  request counts, queue depth, batch sizes and latencies
+  GET /health
+  Frames wait in one queue, from which they are taken in batches (up to
+  max_batch frames, or whatever arrives within batch_wait seconds). Each
+  stream's frames in a batch run as one task on a pool of worker threads,
+  in arrival order, with the stream's own LaneLines. Different streams run
+  in parallel. Once max_queue frames are waiting or in progress, further
+  ones are refused with 503. LaneClient talks to a server from Python:
+  client = LaneClient(port=8080)
+  result = client.frame('front', frame, annotate=True)
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import http.client
+import io
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import cv2
+import numpy as np
+import pipeline
+from lane_lines import RENDER_NONE
+from processing_helpers import LaneThreshold
+from instrumentation import latency_stats
+from buffer_pool import BufferPool
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 409: 'Conflict',
+           413: 'Payload Too Large', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_frame(body, content_type, shape=None):
+    """
+      RGB frame of a request body: an encoded image, a .npy array, or raw
+      bytes of the given (height, width, 3) shape.
+    """
+    content_type = (content_type or '').split(';')[0].strip()
+    if content_type in ('image/jpeg', 'image/png'):
+        frame = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise HTTPError(400, "Could not decode %s frame" % content_type)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    if content_type == 'application/x-npy':
+        try:
+            frame = np.load(io.BytesIO(body), allow_pickle=False)
+        except ValueError as e:
+            raise HTTPError(400, "Could not read .npy frame: %s" % e)
+    elif content_type == 'application/octet-stream':
+        if shape is None:
+            raise HTTPError(400, "Raw frames need an X-Frame-Shape header")
+        try:
+            frame = np.frombuffer(body, np.uint8).reshape(shape)
+        except ValueError:
+            raise HTTPError(400, "%d bytes are not a %s frame"
+                            % (len(body), 'x'.join(map(str, shape))))
+    else:
+        raise HTTPError(400, "Unsupported frame type %r" % content_type)
+    if frame.dtype != np.uint8 or frame.ndim != 3 or frame.shape[2] != 3:
+        raise HTTPError(400, "Frames must be uint8 RGB, got %s %s"
+                        % (frame.shape, frame.dtype))
+    return frame
+
+
+def process_frame(image, lane_lines, warp_first=False, annotated=False,
+                  camera=None, thresh=None, pool=None):
+    """
+      Detect the lane in one frame of a stream tracked by lane_lines, as a
+      result dict, with the annotated frame under 'annotated' if asked for.
+      With the stream's BufferPool as pool, the annotated frame is the
+      pool's next output.
+    """
+    c, t, tw = pipeline.camera_for(camera)
+    lt = tw if warp_first else t
+    binary, undistorted = pipeline.warped_binary(
+        image, warp_first, full_frame=annotated, camera=camera,
+        thresh=thresh, pool=pool)
+    _, curvature, displacement, _ = lane_lines.update(binary,
+                                                      render=RENDER_NONE,
+                                                      pool=pool)
+    result = {'left_fit': lane_lines.left_fit.tolist(),
+              'right_fit': lane_lines.right_fit.tolist(),
+              'curvature': float(curvature),
+              'displacement': float(displacement),
+              'lanes_found': bool(lane_lines.lanes_found)}
+    if annotated:
+        if undistorted is None:
+            undistorted = c.undistort(
+                image, dst=pool.output(image.shape) if pool else None)
+        result['annotated'] = pipeline.annotate(
+            undistorted, lane_lines.lane_polygons(binary.shape), curvature,
+            displacement, lt, pool)
+    return result
+
+
+class _Stream:
+    # lane tracking state and buffers of one stream; its frames run under
+    # lock, in order, and an annotated frame is encoded before the next
+    def __init__(self, camera, warp_first):
+        self.camera = camera
+        self.warp_first = warp_first
+        self.lane_lines = pipeline.new_lane_lines(warp_first, camera)
+        self.pool = BufferPool()
+        self.lock = asyncio.Lock()
+        self.frames = 0
+
+
+_Request = collections.namedtuple('_Request', [
+    'stream', 'body', 'content_type', 'shape', 'annotate', 'received',
+    'future'])
+
+
+class LaneServer:
+    """
+      The service: await server.start(port=8080) (or path= for a Unix
+      socket) on a running event loop, then await server.close(). Frames can
+      also be submitted in process with await server.submit(...).
+    """
+    def __init__(self, workers=None, max_queue=64, max_batch=8,
+                 batch_wait=0.002, max_body=64 << 20, history=1000):
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.max_body = max_body
+        self.address = None
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._local = threading.local()
+        self._streams = {}
+        self._queue = None
+        self._pending = 0
+        self._tasks = set()
+        self._server = None
+        self._counts = collections.Counter()
+        self._latencies = {name: collections.deque(maxlen=history)
+                           for name in ('queue', 'processing', 'total')}
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        self._queue = asyncio.Queue()
+        self._tasks.add(asyncio.create_task(self._dispatch()))
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path)
+            self.address = path
+        else:
+            self._server = await asyncio.start_server(self._handle, host,
+                                                      port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        # wait for frames in flight without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._pool.shutdown)
+
+    def metrics(self):
+        batches = self._counts['batches']
+        return {'requests': self._counts['requests'],
+                'completed': self._counts['completed'],
+                'rejected': self._counts['rejected'],
+                'errors': self._counts['errors'],
+                'queue_depth': self._pending,
+                'max_queue': self.max_queue,
+                'streams': len(self._streams),
+                'batches': batches,
+                'mean_batch_size': (self._counts['batched_frames'] / batches
+                                    if batches else 0.0),
+                'latency': {name: latency_stats(seconds)
+                            for name, seconds in self._latencies.items()
+                            if seconds}}
+
+    async def submit(self, stream_id, body, content_type, shape=None,
+                     annotate=False, camera=None, warp_first=False):
+        """
+          Result of a frame of a stream, once processed. Raises HTTPError
+          for frames refused or that cannot be decoded.
+        """
+        received = time.perf_counter()
+        self._counts['requests'] += 1
+        stream = self._stream(stream_id, camera, warp_first)
+        if self._pending >= self.max_queue:
+            self._counts['rejected'] += 1
+            raise HTTPError(503, "Queue full: %d frames pending"
+                            % self._pending)
+        self._pending += 1
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Request(stream, body, content_type, shape,
+                                        annotate, received, future))
+        try:
+            result = await future
+        finally:
+            self._pending -= 1
+        self._latencies['total'].append(time.perf_counter() - received)
+        self._counts['completed'] += 1
+        return result
+
+    def reset(self, stream_id):
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            raise HTTPError(404, "Unknown stream %r" % stream_id)
+        return {'stream': stream_id, 'frames': stream.frames}
+
+    def _stream(self, stream_id, camera, warp_first):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            if camera is not None and camera not in pipeline.cameras:
+                raise HTTPError(404, "Unknown camera %r" % camera)
+            stream = _Stream(camera, warp_first)
+            self._streams[stream_id] = stream
+        elif ((camera is not None and camera != stream.camera) or
+              warp_first != stream.warp_first):
+            raise HTTPError(409, "Stream %r is camera %r, warp_first=%s"
+                            % (stream_id, stream.camera, stream.warp_first))
+        return stream
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(
+                            self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+            self._counts['batches'] += 1
+            self._counts['batched_frames'] += len(batch)
+            # one task per stream, keeping each stream's frames in order
+            groups = collections.OrderedDict()
+            for request in batch:
+                groups.setdefault(id(request.stream), []).append(request)
+            for requests in groups.values():
+                task = asyncio.create_task(self._run(requests))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, requests):
+        stream = requests[0].stream
+        loop = asyncio.get_running_loop()
+        async with stream.lock:
+            outcomes = await loop.run_in_executor(self._pool, self._process,
+                                                  requests)
+        for request, (result, error) in zip(requests, outcomes):
+            if request.future.done():
+                continue
+            if error is not None:
+                self._counts['errors'] += 1
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+
+    def _threshold(self):
+        # scratch buffers of LaneThreshold must not be shared between threads
+        thresh = getattr(self._local, 'threshold', None)
+        if thresh is None:
+            t = pipeline.threshold
+            thresh = LaneThreshold(t.s_thresh, t.sx_thresh, t.x_thresh)
+            self._local.threshold = thresh
+        return thresh
+
+    def _process(self, requests):
+        # on a worker thread: (result, None) or (None, error) per request
+        outcomes = []
+        for request in requests:
+            start = time.perf_counter()
+            self._latencies['queue'].append(start - request.received)
+            stream = request.stream
+            try:
+                frame = decode_frame(request.body, request.content_type,
+                                     request.shape)
+                result = process_frame(frame, stream.lane_lines,
+                                       stream.warp_first, request.annotate,
+                                       stream.camera, self._threshold(),
+                                       stream.pool)
+                if request.annotate:
+                    ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(
+                        result['annotated'], cv2.COLOR_RGB2BGR))
+                    if not ok:
+                        raise HTTPError(500, "Could not encode the "
+                                        "annotated frame")
+                    result['annotated'] = base64.b64encode(
+                        encoded).decode('ascii')
+                result['frame'] = stream.frames
+                stream.frames += 1
+                end = time.perf_counter()
+                self._latencies['processing'].append(end - start)
+                result['latency_ms'] = 1000 * (end - request.received)
+                outcomes.append((result, None))
+            except HTTPError as e:
+                outcomes.append((None, e))
+            except Exception as e:
+                outcomes.append((None, HTTPError(500, "%s: %s"
+                                                 % (type(e).__name__, e))))
+        return outcomes
+
+    async def _route(self, method, target, headers, body):
+        url = urlsplit(target)
+        query = {name: values[-1]
+                 for name, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['metrics'] or parts == ['health']:
+            if method != 'GET':
+                raise HTTPError(405, "Use GET for /%s" % parts[0])
+            return self.metrics() if parts == ['metrics'] else {'status':
+                                                                'ok'}
+        if len(parts) == 2 and parts[0] == 'streams':
+            if method != 'DELETE':
+                raise HTTPError(405, "Use DELETE for a stream")
+            return self.reset(parts[1])
+        if len(parts) == 3 and parts[0] == 'streams' and \
+                parts[2] == 'frames':
+            if method != 'POST':
+                raise HTTPError(405, "Use POST for frames")
+            shape = headers.get('x-frame-shape')
+            if shape is not None:
+                try:
+                    shape = tuple(int(n) for n in shape.split(','))
+                except ValueError:
+                    raise HTTPError(400, "Bad X-Frame-Shape %r" % shape)
+            result = await self.submit(
+                parts[1], body, headers.get('content-type'), shape,
+                annotate=query.get('annotate', '0') not in ('0', 'false'),
+                camera=query.get('camera'),
+                warp_first=query.get('warp_first', '0') not in ('0',
+                                                                'false'))
+            result['stream'] = parts[1]
+            return result
+        raise HTTPError(404, "No such resource %s" % url.path)
+
+    async def _handle(self, reader, writer):
+        # one connection: requests answered in turn, kept alive unless
+        # asked otherwise
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    method, target, _ = request_line.decode(
+                        'latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    self._respond(writer, 400, {'error': "Bad request"},
+                                  False)
+                    break
+                if length > self.max_body:
+                    self._respond(writer, 413, {'error': "Frame over %d "
+                                                "bytes" % self.max_body},
+                                  False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                try:
+                    status, payload = 200, await self._route(method, target,
+                                                             headers, body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
+                self._respond(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _respond(writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                      'Content-Length: %d\r\nConnection: %s\r\n\r\n'
+                      % (status, REASONS[status], len(body),
+                         'keep-alive' if keep_alive else 'close')
+                      ).encode('latin-1') + body)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class LaneClient:
+    """
+      Blocking client of a LaneServer, over one kept-alive connection to
+      host and port, or to the Unix socket at path.
+    """
+    def __init__(self, host='127.0.0.1', port=8080, path=None, timeout=30):
+        if path is not None:
+            self._connection = _UnixHTTPConnection(path, timeout)
+        else:
+            self._connection = http.client.HTTPConnection(host, port,
+                                                          timeout=timeout)
+
+    def request(self, method, url, body=None, headers=None):
+        self._connection.request(method, url, body, headers or {})
+        response = self._connection.getresponse()
+        payload = json.loads(response.read())
+        if response.status != 200:
+            raise HTTPError(response.status, payload.get('error'))
+        return payload
+
+    def frame(self, stream_id, frame, annotate=False, camera=None,
+              warp_first=False, fmt='npy'):
+        """
+          Result of an RGB frame of a stream, sent as a .npy array, raw
+          bytes ('raw') or an encoded 'jpg' or 'png' image. The annotated
+          frame, if asked for, is decoded to RGB.
+        """
+        if fmt == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, frame, allow_pickle=False)
+            body, headers = buffer.getvalue(), {
+                'Content-Type': 'application/x-npy'}
+        elif fmt == 'raw':
+            body = np.ascontiguousarray(frame).tobytes()
+            headers = {'Content-Type': 'application/octet-stream',
+                       'X-Frame-Shape': ','.join(map(str, frame.shape))}
+        else:
+            ok, encoded = cv2.imencode('.' + fmt, cv2.cvtColor(
+                frame, cv2.COLOR_RGB2BGR))
+            if not ok:
+                raise ValueError("Could not encode frame as %s" % fmt)
+            body = encoded.tobytes()
+            headers = {'Content-Type': 'image/jpeg' if fmt == 'jpg'
+                       else 'image/' + fmt}
+        query = []
+        if annotate:
+            query.append('annotate=1')
+        if camera is not None:
+            query.append('camera=' + camera)
+        if warp_first:
+            query.append('warp_first=1')
+        url = '/streams/%s/frames' % stream_id
+        if query:
+            url += '?' + '&'.join(query)
+        result = self.request('POST', url, body, headers)
+        if 'annotated' in result:
+            annotated = cv2.imdecode(np.frombuffer(base64.b64decode(
+                result['annotated']), np.uint8), cv2.IMREAD_COLOR)
+            result['annotated'] = cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
+        return result
+
+    def reset(self, stream_id):
+        return self.request('DELETE', '/streams/%s' % stream_id)
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+    def close(self):
+        self._connection.close()
+
+
+async def serve(host='127.0.0.1', port=8080, path=None, **server_args):
+    server = LaneServer(**server_args)
+    await server.start(host, port, path)
+    print("Serving lane detection on %s" % (server.address,))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', help='serve on a Unix socket at this path')
+    parser.add_argument('--workers', type=int, help='worker threads')
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--batch-wait', type=float, default=0.002,
+                        help='seconds to wait for a batch to fill')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix,
+                          workers=args.workers, max_queue=args.max_queue,
+                          max_batch=args.max_batch,
+                          batch_wait=args.batch_wait))
+    except KeyboardInterrupt:
+        pass
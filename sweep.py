@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+  Parameter sweeps over the thresholds of LaneThreshold (s_thresh,
+  sx_thresh, x_thresh) and the sliding window hyperparameters of LaneLines
+  (nwindows, margin, minpix, offset). Every combination of the given values
+  is run over a sequence of frames, an image glob or a .npy frame store,
+  with unswept parameters at their pipeline defaults, and summarized in a
+  CSV table. E.g.
+  ./sweep.py 'video_images/*.jpg' --grid '{"s_thresh": [[150, 255],
+      [170, 255]], "margin": [12, 16, 20]}' --output sweep.csv
+  The expensive stages run once per frame, not once per combination: each
+  frame is undistorted (or warped, in warp-first mode) and its S channel
+  and gradients computed up front, into a memory-mapped array that worker
+  processes share. Workers threshold, warp and track from there, computing
+  each distinct threshold mask and binary image once per frame.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from processing_helpers import *
+from lane_lines import *
+from frame_store import FrameStore, is_store, image_store
+from batch import map_batch
+import pipeline
+
+THRESHOLD_PARAMETERS = ('s_thresh', 'sx_thresh', 'x_thresh')
+LANE_PARAMETERS = ('nwindows', 'margin', 'minpix', 'offset')
+
+
+def default_parameters():
+    """
+      The swept parameters, as the pipeline sets them.
+    """
+    ll = pipeline.new_lane_lines()
+    parameters = {name: tuple(getattr(pipeline.threshold, name))
+                  for name in THRESHOLD_PARAMETERS}
+    parameters.update((name, getattr(ll, name)) for name in LANE_PARAMETERS)
+    return parameters
+
+
+def combinations(grid):
+    """
+      Every combination of the values in grid (parameter name -> list of
+      values), as parameter dicts with unswept parameters at their defaults.
+      Combinations sharing thresholds are consecutive.
+    """
+    defaults = default_parameters()
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError("Unknown sweep parameters %s, expected some of %s"
+                         % (sorted(unknown), sorted(defaults)))
+    names = THRESHOLD_PARAMETERS + LANE_PARAMETERS
+    values = [[tuple(value) if name in THRESHOLD_PARAMETERS else value
+               for value in grid.get(name, [defaults[name]])]
+              for name in names]
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*values)]
+
+
+def threshold_key(parameters):
+    # the threshold parameters of a combination
+    return tuple(parameters[name] for name in THRESHOLD_PARAMETERS)
+
+
+def chunk_bounds(parameter_sets, workers):
+    """
+      Bounds of at most workers contiguous chunks of parameter_sets, cut only
+      between groups of combinations sharing thresholds when there are at
+      least as many groups as workers, so that each group's masks are
+      computed by one worker. With fewer groups, each group is split across
+      a share of the workers in proportion to its size, and every piece
+      computes its group's masks.
+    """
+    n = len(parameter_sets)
+    keys = [threshold_key(parameters) for parameters in parameter_sets]
+    edges = [0] + [i for i in range(1, n) if keys[i] != keys[i - 1]] + [n]
+    groups = len(edges) - 1
+    if groups >= workers:
+        # the group edges closest to an even split
+        inner = np.array(edges[1:-1])
+        cuts = {int(inner[np.argmin(np.abs(inner - target))])
+                for target in np.linspace(0, n, workers + 1)[1:-1]}
+        return [0] + sorted(cuts) + [n]
+    sizes = np.diff(edges)
+    shares = np.maximum(1, np.floor(workers * sizes / n).astype(int))
+    # hand out the remaining workers to the largest groups
+    for i in np.argsort(-sizes)[:max(0, workers - shares.sum())]:
+        shares[i] += 1
+    bounds = [0]
+    for start, stop, share in zip(edges[:-1], edges[1:], shares):
+        bounds.extend(np.linspace(start, stop, min(share, stop - start) + 1
+                                  ).astype(int)[1:].tolist())
+    return bounds
+
+
+def region_shape(frame_shape, warp_first=False):
+    # shape of the region of a frame the pipeline thresholds
+    if warp_first:
+        return pipeline.tw.warped_shape(frame_shape)[:2]
+    x0, y0, x1, y1 = pipeline.t.source_box(frame_shape)
+    return y1 - y0, x1 - x0
+
+
+def prepare_channels(frames, path, warp_first=False, workers=None):
+    """
+      Write the threshold intermediates of each frame (LaneThreshold.channels
+      of the region the pipeline thresholds) to an (N, 3, h, w) int16 array
+      memory-mapped at path: S channel, absolute x gradient of S and of
+      gray, each contiguous. Returns the array.
+    """
+    frame_shape = frames[0].shape
+    channels = np.lib.format.open_memmap(
+        path, mode='w+', dtype=np.int16,
+        shape=(len(frames), 3) + tuple(region_shape(frame_shape,
+                                                    warp_first)))
+    box = pipeline.t.source_box(frame_shape)
+
+    def prepare(frame, dst, thresh):
+        if warp_first:
+            region = pipeline.tw.transform_raw(frame)
+        else:
+            region = pipeline.c.undistort(frame, box=box)
+        for i, channel in enumerate(thresh.channels(region)):
+            dst[i] = channel
+
+    map_batch(prepare, frames, channels, workers, make_state=LaneThreshold)
+    channels.flush()
+    return channels
+
+
+class _Results:
+    # per combination measurements, summarized as a table row
+    def __init__(self, parameters, meters_per_pixel):
+        self.parameters = parameters
+        self.meters_per_pixel = meters_per_pixel
+        self.found = []
+        self.curvatures = []
+        self.displacements = []
+        self.widths = []
+
+    def record(self, ll, curvature, displacement, shape):
+        y_eval = shape[0] - 1
+        self.found.append(ll.lanes_found)
+        self.curvatures.append(curvature)
+        self.displacements.append(displacement)
+        self.widths.append(self.meters_per_pixel *
+                           (np.polyval(ll.right_fit, y_eval) -
+                            np.polyval(ll.left_fit, y_eval)))
+
+    def row(self):
+        row = dict(self.parameters)
+        displacements = np.array(self.displacements)
+        row.update({
+            'frames': len(self.found),
+            'lanes_found': float(np.mean(self.found)),
+            'median_curvature_m': float(np.median(self.curvatures)),
+            'mean_displacement_m': float(np.mean(displacements)),
+            'displacement_jitter_m': float(np.mean(np.abs(
+                np.diff(displacements)))) if len(displacements) > 1 else 0.0,
+            'mean_lane_width_m': float(np.mean(self.widths)),
+            'lane_width_std_m': float(np.std(self.widths))})
+        return row
+
+
+def evaluate(channels_path, frame_shape, parameter_sets, warp_first=False,
+             track=True):
+    """
+      Table rows for parameter_sets, each run as a stream over the frames
+      whose intermediates are stored at channels_path (see
+      prepare_channels). Without track, every frame is detected afresh.
+    """
+    channels = np.load(channels_path, mmap_mode='r')
+    lt = pipeline.tw if warp_first else pipeline.t
+    trackers = [LaneLines(lt.meters_per_pixel, scale=lt.scale,
+                          **{name: parameters[name]
+                             for name in LANE_PARAMETERS})
+                for parameters in parameter_sets]
+    results = [_Results(parameters, lt.meters_per_pixel)
+               for parameters in parameter_sets]
+    for s_channel, sobel_s, sobel_gray in channels:
+        # each distinct mask and binary image is computed once per frame
+        masks = {}
+        binaries = {}
+
+        def mask(name, thresh):
+            if (name, thresh) not in masks:
+                if name == 's_thresh':
+                    masks[name, thresh] = cv2.inRange(s_channel, *thresh)
+                else:
+                    sobel = sobel_s if name == 'sx_thresh' else sobel_gray
+                    masks[name, thresh] = scaled_threshold(sobel, *thresh)
+            return masks[name, thresh]
+
+        for ll, result in zip(trackers, results):
+            key = threshold_key(result.parameters)
+            if key not in binaries:
+                binary = cv2.bitwise_or(mask('s_thresh', key[0]),
+                                        mask('sx_thresh', key[1]))
+                cv2.bitwise_or(binary, mask('x_thresh', key[2]), dst=binary)
+                to_binary(binary)
+                if not warp_first:
+                    binary = lt.transform_cropped(binary, frame_shape)
+                binaries[key] = binary
+            binary = binaries[key]
+            if not track:
+                ll.reset()
+            _, curvature, displacement, _ = ll.update(binary,
+                                                      render=RENDER_NONE)
+            result.record(ll, curvature, displacement, binary.shape)
+    return [result.row() for result in results]
+
+
+def sweep(frames, grid, warp_first=False, track=True, workers=None,
+          scratch_dir=None):
+    """
+      Table rows (dicts of parameters and measurements) for every
+      combination of grid over frames, an (N, H, W, 3) array or a list of
+      frames of one shape. Combinations are split across workers processes
+      (os.cpu_count() by default), keeping those that share thresholds
+      together (see chunk_bounds). Intermediates are kept in scratch_dir (a
+      temporary directory by default) while the sweep runs.
+    """
+    parameter_sets = combinations(grid)
+    workers = max(1, min(workers or os.cpu_count() or 1,
+                         len(parameter_sets)))
+    frame_shape = frames[0].shape
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp_dir:
+        channels_path = os.path.join(tmp_dir, 'channels.npy')
+        prepare_channels(frames, channels_path, warp_first)
+        if workers == 1:
+            return evaluate(channels_path, frame_shape, parameter_sets,
+                            warp_first, track)
+        bounds = chunk_bounds(parameter_sets, workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(evaluate, channels_path, frame_shape,
+                                   parameter_sets[start:stop], warp_first,
+                                   track)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            return [row for future in futures for row in future.result()]
+
+
+def load_frames(source):
+    # frames of a frame store, or of images matching a glob
+    if is_store(source):
+        return FrameStore.open(source).frames
+    return image_store(source, pipeline.cache_dir).frames
+
+
+def write_table(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('frames', help='image glob or .npy frame store')
+    parser.add_argument('--grid', default='{}',
+                        help='JSON object of parameter name -> values')
+    parser.add_argument('--output', default='sweep_results.csv')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--warp-first', action='store_true')
+    parser.add_argument('--independent', action='store_true',
+                        help='detect each frame afresh, without tracking')
+    args = parser.parse_args()
+    rows = sweep(load_frames(args.frames), json.loads(args.grid),
+                 warp_first=args.warp_first, track=not args.independent,
+                 workers=args.workers)
+    write_table(rows, args.output)
+    for row in sorted(rows, key=lambda row: -row['lanes_found'])[:10]:
+        print(row)
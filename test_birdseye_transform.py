@@ -2,9 +2,9 @@
 
 from camera_calibration import *
 from birdseye_transform import *
+from frame_store import image_store
 import os
 import matplotlib.image as mpimg
-import glob
 
 test_glob = 'test_images/*.jpg'
 out_dir = 'intermediate/'
@@ -12,9 +12,8 @@ c = CameraCalibration('camera_cal/calibration*.jpg')
 t = BirdsEyeTransform(c, 'test_images/straight_lines*jpg')
 print("Meters per pixel: %s" % str(t.meters_per_pixel))
 
-for fname in glob.glob(test_glob):
-    in_img = mpimg.imread(fname)
-    name = fname.split('/')[-1][:-4]
+store = image_store(test_glob, 'cache')
+for name, in_img in zip(store.names, store.frames):
     undistorted = c.undistort(in_img)
     mpimg.imsave(out_dir + name + "_undistorted.jpg", undistorted)
     gray = cv2.cvtColor(undistorted, cv2.COLOR_BGR2GRAY)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+from buffer_pool import *
+import glob
+import time
+import matplotlib.image as mpimg
+import numpy as np
+import instrumentation
+import pipeline
+from frame_stream import stream
+
+
+def test_pool_reuses_buffers():
+    frames = [mpimg.imread(fname)
+              for fname in sorted(glob.glob('video_images/*.jpg'))[:6]]
+    for warp_first in (False, True):
+        ll = pipeline.new_lane_lines(warp_first)
+        pooled_ll = pipeline.new_lane_lines(warp_first)
+        pool = BufferPool(outputs=2)
+        outputs = []
+        for i, frame in enumerate(frames):
+            expected = pipeline.process_image(frame, lane_lines=ll,
+                                              warp_first=warp_first)
+            annotated = pipeline.process_image(frame, lane_lines=pooled_ll,
+                                               warp_first=warp_first,
+                                               pool=pool)
+            assert np.array_equal(annotated, expected)
+            outputs.append(annotated)
+            if i == 1:
+                allocations = pool.allocations
+        # nothing allocated after the output ring is full, which it cycles
+        assert pool.allocations == allocations
+        assert outputs[0] is outputs[2] and outputs[1] is not outputs[2]
+
+
+def test_tracked_frames_allocate_little():
+    frames = [mpimg.imread(fname)
+              for fname in sorted(glob.glob('video_images/project*.jpg'))]
+    for warp_first in (False, True):
+        ll = pipeline.new_lane_lines(warp_first)
+        pool = BufferPool(outputs=2)
+        inst = instrumentation.Instrumentation(track_allocations=True)
+        with inst.active():
+            for frame in frames:
+                with inst.frame():
+                    pipeline.process_image(frame, lane_lines=ll,
+                                           warp_first=warp_first, pool=pool)
+        # once the output ring is full, a frame tracked from the prior fits
+        # allocates only its lane pixels, a fraction of a frame
+        tracked = [record['allocated_peak'] for record in inst.records[2:]
+                   if not record['counters'].get('sliding_window_searches')]
+        assert len(tracked) > len(frames) // 2
+        assert max(tracked) < frames[0].nbytes // 4
+
+
+class SlowSink:
+    # keeps a copy of each frame, written slower than frames are processed
+    # so that the stream's queues fill
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frame):
+        time.sleep(0.3)
+        self.frames.append(frame.copy())
+
+    def close(self):
+        pass
+
+
+def test_streamed_outputs_stay_valid():
+    frames = [mpimg.imread(fname)
+              for fname in sorted(glob.glob('video_images/*.jpg'))[:12]]
+    ll = pipeline.new_lane_lines()
+    expected = [pipeline.process_image(frame, lane_lines=ll)
+                for frame in frames]
+    process = pipeline.AdaptiveProcessor(deadline=60.0, maxsize=8)
+    sink = SlowSink()
+    stream(frames, process, sink, maxsize=process.maxsize)
+    assert len(sink.frames) == len(frames)
+    assert all(np.array_equal(a, b) for a, b in zip(sink.frames, expected))
+
+
+if __name__ == "__main__":
+    test_pool_reuses_buffers()
+    test_tracked_frames_allocate_little()
+    test_streamed_outputs_stay_valid()
+    print("BufferPool reuses its buffers across frames")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import calibration_cache
+import os
+import tempfile
+import numpy as np
+
+
+def test_save_and_load():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        mtx = np.arange(9.0).reshape(3, 3)
+        calibration_cache.save(cache_dir, 'calibration', 'abc', mtx=mtx,
+                               size=np.array([720, 1280]))
+        cached = calibration_cache.load(cache_dir, 'calibration', 'abc')
+        assert sorted(cached) == ['mtx', 'size']
+        assert (cached['mtx'] == mtx).all()
+        assert calibration_cache.load(cache_dir, 'calibration', 'x') is None
+
+
+def test_stale_entries_are_recomputed():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fname = os.path.join(cache_dir, 'image.jpg')
+        with open(fname, 'wb') as f:
+            f.write(b'first')
+        key = calibration_cache.cache_key([fname], (9, 6))
+        assert key == calibration_cache.cache_key([fname], (9, 6))
+        assert key != calibration_cache.cache_key([fname], (9, 5))
+        # changed input content gives another key, so a cache miss
+        with open(fname, 'wb') as f:
+            f.write(b'second')
+        assert key != calibration_cache.cache_key([fname], (9, 6))
+        # entries of another cache version are not used
+        calibration_cache.save(cache_dir, 'calibration', key,
+                               mtx=np.eye(3))
+        version = calibration_cache.CACHE_VERSION
+        calibration_cache.CACHE_VERSION = version + 1
+        try:
+            assert calibration_cache.load(cache_dir, 'calibration',
+                                          key) is None
+        finally:
+            calibration_cache.CACHE_VERSION = version
+        assert calibration_cache.load(cache_dir, 'calibration',
+                                      key) is not None
+
+
+def test_failed_save_leaves_no_partial_file():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        calibration_cache.save(cache_dir, 'calibration', 'abc',
+                               mtx=np.eye(3))
+        savez = np.savez
+
+        def interrupted_savez(f, **arrays):
+            f.write(b'partial')
+            raise RuntimeError("interrupted")
+
+        np.savez = interrupted_savez
+        try:
+            calibration_cache.save(cache_dir, 'calibration', 'abc',
+                                   mtx=np.zeros(3))
+            assert False
+        except RuntimeError:
+            pass
+        finally:
+            np.savez = savez
+        # the earlier entry is intact, and no temporary file is left
+        assert os.listdir(cache_dir) == ['calibration-abc.npz']
+        cached = calibration_cache.load(cache_dir, 'calibration', 'abc')
+        assert (cached['mtx'] == np.eye(3)).all()
+
+
+if __name__ == "__main__":
+    test_save_and_load()
+    test_stale_entries_are_recomputed()
+    test_failed_save_leaves_no_partial_file()
+    print("Calibration cache entries round trip and go stale")
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from camera_calibration import *
+from frame_store import image_store
 import os
 import matplotlib.image as mpimg
 import glob
@@ -12,8 +13,12 @@ out_dir = "intermediate/"
 
 c = CameraCalibration(cal_glob)
 
-for fname in (glob.glob(test_glob) + glob.glob(cal_glob)):
-    in_img = mpimg.imread(fname)
+store = image_store(test_glob, 'cache')
+# calibration images come in two sizes, so are decoded one by one rather
+# than kept in a frame store
+images = (list(zip(store.names, store.frames)) +
+          [(fname.split('/')[-1][:-4], mpimg.imread(fname))
+           for fname in glob.glob(cal_glob)])
+for name, in_img in images:
     undistorted = c.undistort(in_img)
-    mpimg.imsave(out_dir + fname.split('/')[-1][:-4] + "_undistorted.jpg",
-                 undistorted)
+    mpimg.imsave(out_dir + name + "_undistorted.jpg", undistorted)
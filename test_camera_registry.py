@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+from camera_registry import *
+import numpy as np
+
+
+def test_map_cache_evicts_least_recently_used():
+    cache = MapCache(budget=3000)
+    a, b = cache.namespace('a'), cache.namespace('b')
+    a['maps'] = (np.zeros(1000, np.uint8), np.zeros(500, np.uint8))
+    b['maps'] = np.zeros(1000, np.uint8)
+    a['box'] = (0, 440, 1280, 719)
+    assert cache.nbytes == 2500 and len(cache) == 3
+    a['maps']  # now more recently used than b's
+    b['other'] = np.zeros(1000, np.uint8)
+    assert 'maps' not in b and 'maps' in a and 'other' in b
+    assert b.get('maps') is None
+    assert cache.nbytes == 2500 and cache.evictions == 1
+    # the newest entry is kept even when over budget on its own
+    cache.budget = 100
+    assert len(cache) == 1 and 'other' in b
+
+
+if __name__ == "__main__":
+    test_map_cache_evicts_least_recently_used()
+    print("MapCache evicts least recently used tables")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+from camera_calibration import *
+from birdseye_transform import *
+import matplotlib.image as mpimg
+import glob
+
+straight_glob = 'test_images/straight_lines*.jpg'
+# meters per pixel inferred by the original per-pixel implementation, with
+# the calibration images of the most common size
+expected_meters_per_pixel = 0.04232909379968204
+
+
+def reference_dash_pixel_length(binary_image, left_line, right_line,
+                                line_dist_threshold=8,
+                                distinct_dash_threshold=3):
+    # the original per-pixel implementation
+    def distance(lp1, lp2, p):
+        lp1 = np.asarray(lp1)
+        lp2 = np.asarray(lp2)
+        p = np.asarray(p)
+        return (np.linalg.norm(np.cross(lp2-lp1, lp1-p)) /
+                np.linalg.norm(lp2-lp1))
+
+    nonzero = binary_image.nonzero()
+    left_y = []
+    right_y = []
+    for i in range(len(nonzero[0])):
+        p = (nonzero[1][i], nonzero[0][i])
+        if distance(left_line[0], left_line[1], p) < line_dist_threshold:
+            left_y.append(p[1])
+        if distance(right_line[0], right_line[1], p) < line_dist_threshold:
+            right_y.append(p[1])
+    left_y.sort(reverse=True)
+    right_y.sort(reverse=True)
+    dash_length = binary_image.shape[1]
+    for y_vals in [left_y, right_y]:
+        lengths = []
+        last_y = y_vals[0]
+        current_length = 0
+        for y in y_vals:
+            if (last_y - y) > distinct_dash_threshold:
+                lengths.append(current_length)
+                current_length = 0
+                last_y = y
+            else:
+                current_length += (last_y - y)
+                last_y = y
+        lengths.append(current_length)
+        dash_length = min(dash_length, [l for l in lengths if l > 30][0])
+    return dash_length
+
+
+def test_dash_pixel_length():
+    c = CameraCalibration('camera_cal/calibration*.jpg')
+    t = BirdsEyeTransform(c, straight_glob)
+    assert np.isclose(t.meters_per_pixel, expected_meters_per_pixel,
+                      rtol=1e-12)
+    for fname in glob.glob(straight_glob):
+        image = c.undistort(mpimg.imread(fname))
+        binary_combo = np.bitwise_or(sobel_x_filter(image), s_filter(image))
+        transformed = t.transform(binary_combo)
+        x_offset = 0.5*BirdsEyeTransform.LANE_WIDTH/t.meters_per_pixel
+        h, w = transformed.shape
+        left = ((0.5*w - x_offset, h), (0.5*w - x_offset, 0))
+        right = ((0.5*w + x_offset, h), (0.5*w + x_offset, 0))
+        expected = reference_dash_pixel_length(transformed, left, right)
+        assert dash_pixel_length(transformed, left, right) == expected
+
+
+if __name__ == "__main__":
+    test_dash_pixel_length()
+    print("dash_pixel_length matches the reference implementation")
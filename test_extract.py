@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+from extract import *
+import os
+import tempfile
+import cv2
+import numpy as np
+import matplotlib.image as mpimg
+from frame_store import FrameStore
+
+
+def write_clip(path, frames, fps=10):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                             (frames[0].shape[1], frames[0].shape[0]))
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    writer.release()
+
+
+def frame_levels(frames):
+    """
+      The grey level of each (uniform) frame, to the nearest multiple of 20.
+    """
+    return [int(round(np.mean(frame) / 20)) for frame in frames]
+
+
+def test_extract_selected_frames():
+    # frame i of the clip is uniformly grey, at level 20 * i
+    frames = [np.full((64, 96, 3), 20 * i, np.uint8) for i in range(12)]
+    wanted = [9, 1, 4, 5, 4, 11, 30]
+    with tempfile.TemporaryDirectory() as tmp:
+        movie = os.path.join(tmp, 'clip.mp4')
+        write_clip(movie, frames)
+        assert list(select_indices(12, indices=wanted)) == [1, 4, 5, 9, 11]
+        paths = extract_frames(movie, os.path.join(tmp, 'png'),
+                               indices=wanted, fmt='png', workers=2)
+        assert [os.path.basename(p) for p in paths] == \
+            ['clip-0.1.png', 'clip-0.4.png', 'clip-0.5.png', 'clip-0.9.png',
+             'clip-1.1.png']
+        images = [mpimg.imread(p) * 255 for p in paths]
+        assert frame_levels(images) == [1, 4, 5, 9, 11]
+        path, = extract_frames(movie, os.path.join(tmp, 'raw'),
+                               indices=wanted, fmt='raw', workers=2)
+        store = FrameStore.open(path)
+        assert list(store.names) == [os.path.splitext(
+            os.path.basename(p))[0] for p in paths]
+        assert frame_levels(store) == [1, 4, 5, 9, 11]
+
+
+if __name__ == "__main__":
+    test_extract_selected_frames()
+    print("extract writes the selected frames of a video")
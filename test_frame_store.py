@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+from frame_store import *
+import glob
+import os
+import shutil
+import tempfile
+import numpy as np
+import matplotlib.image as mpimg
+
+
+def test_frame_store_round_trip():
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 256, (5, 12, 16, 3), np.uint8)
+    with tempfile.TemporaryDirectory() as store_dir:
+        path = os.path.join(store_dir, 'clip')
+        store = FrameStore.create(path, len(frames), frames.shape[1:],
+                                  names=['a', 'b', 'c', 'd', 'e'],
+                                  timestamps=[0.0, 0.04, 0.08, 0.12, 0.16])
+        store.frames[:] = frames
+        store.flush()
+        del store
+        store = FrameStore.open(path + '.npy')
+        assert len(store) == 5
+        assert store.names[2] == 'c' and store.timestamps[2] == 0.08
+        assert (store[1:4] == frames[1:4]).all()
+        # slices are views of the mapped file, not copies
+        assert np.shares_memory(store[1:4], store.frames)
+
+
+def test_image_store():
+    fnames = sorted(glob.glob('test_images/*.jpg'))
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = image_store('test_images/*.jpg', store_dir)
+        assert len(store) == len(fnames)
+        assert (store[-1] == mpimg.imread(fnames[-1])).all()
+        # reused once built
+        assert image_store('test_images/*.jpg', store_dir).path == store.path
+
+
+def test_image_store_follows_renames():
+    with tempfile.TemporaryDirectory() as tmp:
+        image_dir = os.path.join(tmp, 'images')
+        os.makedirs(image_dir)
+        for fname in sorted(glob.glob('test_images/test*.jpg'))[:3]:
+            shutil.copy(fname, image_dir)
+        image_glob = os.path.join(image_dir, '*.jpg')
+        store = image_store(image_glob, tmp)
+        assert store.names == ['test1', 'test2', 'test3']
+        first = np.array(store[0])
+        # the same contents under other names, and so in another order
+        os.rename(os.path.join(image_dir, 'test1.jpg'),
+                  os.path.join(image_dir, 'test9.jpg'))
+        renamed = image_store(image_glob, tmp)
+        assert renamed.path != store.path
+        assert renamed.names == ['test2', 'test3', 'test9']
+        assert (renamed[2] == first).all()
+
+
+if __name__ == "__main__":
+    test_frame_store_round_trip()
+    test_image_store()
+    test_image_store_follows_renames()
+    print("Frame stores round trip")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+from frame_stream import *
+import time
+
+
+class ListSink:
+    # records frames, optionally failing on the nth write or slowly
+    def __init__(self, fail_at=None, delay=0.0):
+        self.frames = []
+        self.closed = False
+        self.fail_at = fail_at
+        self.delay = delay
+
+    def write(self, frame):
+        if len(self.frames) == self.fail_at:
+            raise IOError("sink failed")
+        time.sleep(self.delay)
+        self.frames.append(frame)
+
+    def close(self):
+        self.closed = True
+
+
+def failing_source(count):
+    for i in range(count):
+        yield i
+    raise IOError("source failed")
+
+
+def raises(fn, exception):
+    try:
+        fn()
+    except exception as e:
+        return e
+    assert False, "%s not raised" % exception.__name__
+
+
+def test_stream_keeps_order_and_bounds():
+    maxsize = 2
+    produced, processed = [0], []
+
+    def frames():
+        for i in range(60):
+            produced[0] += 1
+            yield i
+
+    sink = ListSink(delay=0.001)
+
+    def process(frame):
+        # the source runs at most maxsize frames ahead (plus the frame in
+        # hand on each side), and the sink at most frames_in_flight behind
+        assert produced[0] - len(processed) <= maxsize + 2
+        assert len(processed) - len(sink.frames) <= frames_in_flight(maxsize)
+        processed.append(frame)
+        return frame * 2
+
+    assert stream(frames(), process, sink, maxsize) == 60
+    assert sink.frames == [2 * i for i in range(60)] and sink.closed
+
+
+def test_stream_raises_failures():
+    sink = ListSink()
+    raises(lambda: stream(failing_source(5), lambda x: x, sink), IOError)
+    assert sink.frames == list(range(5)) and sink.closed
+
+    def process(frame):
+        if frame == 3:
+            raise ValueError("process failed")
+        return frame
+    sink = ListSink()
+    raises(lambda: stream(range(10), process, sink), ValueError)
+    assert sink.frames == [0, 1, 2] and sink.closed
+
+    # after the sink fails, queued frames are drained rather than left to
+    # block processing, and the sink's exception is raised
+    sink = ListSink(fail_at=3)
+    e = raises(lambda: stream(range(100), lambda x: x, sink, maxsize=2),
+               IOError)
+    assert str(e) == "sink failed" and sink.frames == [0, 1, 2]
+    assert sink.closed
+
+
+if __name__ == "__main__":
+    test_stream_keeps_order_and_bounds()
+    test_stream_raises_failures()
+    print("stream keeps order, bounds its queues and raises failures")
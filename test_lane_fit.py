@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+from lane_lines import *
+import numpy as np
+
+
+def lane_pixels(rng, count, height=720):
+    y = rng.randint(0, height, count)
+    x = np.int32(0.0003*y**2 - 0.1*y + 300 + 5*rng.randn(count))
+    return x, y
+
+
+def test_lane_fit_matches_polyfit():
+    rng = np.random.RandomState(0)
+    x, y = lane_pixels(rng, 5000)
+    assert np.allclose(LaneFit(720).add(x, y).coefficients(),
+                       np.polyfit(y, x, 2), rtol=1e-9)
+    weights = rng.rand(len(x))
+    assert np.allclose(LaneFit(720).add(x, y, weights).coefficients(),
+                       np.polyfit(y, x, 2, w=np.sqrt(weights)), rtol=1e-9)
+    # pixels added in batches, with earlier ones decayed
+    x2, y2 = lane_pixels(rng, 3000)
+    fit = LaneFit(720).add(x, y).decay(0.5).add(x2, y2)
+    weights = np.concatenate((np.full(len(x), 0.5), np.ones(len(x2))))
+    assert np.allclose(fit.coefficients(),
+                       np.polyfit(np.concatenate((y, y2)),
+                                  np.concatenate((x, x2)), 2,
+                                  w=np.sqrt(weights)), rtol=1e-9)
+
+
+def test_radius_of_curvature():
+    # the original curvature calculation: a fit in meters to resampled points
+    fit = np.array([0.0003, -0.1, 300.0])
+    mpp = 0.042
+    ploty = np.linspace(0, 719, 720)
+    fit_cr = np.polyfit(mpp * ploty, mpp * np.polyval(fit, ploty), 2)
+    expected = (((1 + (2 * fit_cr[0] * 719 * mpp + fit_cr[1]) ** 2) ** 1.5) /
+                np.absolute(2 * fit_cr[0]))
+    assert np.isclose(radius_of_curvature(fit, 719, mpp), expected,
+                      rtol=1e-9)
+
+
+if __name__ == "__main__":
+    test_lane_fit_matches_polyfit()
+    test_radius_of_curvature()
+    print("LaneFit matches np.polyfit")
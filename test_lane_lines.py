@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+from lane_lines import *
+import glob
+import matplotlib.image as mpimg
+import numpy as np
+import pipeline
+
+
+def test_reduce_mask():
+    rng = np.random.RandomState(0)
+    binary = np.uint8(rng.rand(721, 1283) < 0.01)
+    for factor in (2, 4):
+        h, w = binary.shape[0] // factor, binary.shape[1] // factor
+        blocks = binary[:h * factor, :w * factor].reshape(h, factor, w,
+                                                          factor)
+        assert ((reduce_mask(binary, factor) > 0) ==
+                blocks.any(axis=(1, 3))).all()
+    for factor in (3, 8):
+        try:
+            LaneLines(0.05, coarse=factor)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_band_pixels_match_full_search():
+    rng = np.random.RandomState(1)
+    binary = np.uint8(rng.rand(720, 1280) < 0.05)
+    fit = np.array([0.0004, -0.3, 400.0])
+    x, y = nonzero_pixels(binary)
+    inside = np.abs(x - np.polyval(fit, y)) < 12
+    band_x, band_y = band_pixels(binary, fit, 12)
+    assert (band_x == x[inside]).all() and (band_y == y[inside]).all()
+
+
+def test_window_bases():
+    for fname in sorted(glob.glob('test_images/*.jpg')):
+        binary, _ = pipeline.warped_binary(mpimg.imread(fname))
+        x, y = nonzero_pixels(binary)
+        ll = pipeline.new_lane_lines()
+        fixed = ll._window_bases(x, y, binary.shape)
+        # by default the bases are the fixed ones, offset from the centre
+        midpoint, offset = binary.shape[1] // 2, ll._px(ll.offset)
+        assert fixed == (midpoint - offset, midpoint + offset)
+        # seeded from the histogram, they stay on the same lines where the
+        # car is centred in a clean lane
+        ll.seed_bases = True
+        seeded = ll._window_bases(x, y, binary.shape)
+        if 'straight_lines' in fname:
+            assert all(abs(a - b) <= ll._px(ll.margin) // 4
+                       for a, b in zip(seeded, fixed))
+
+
+if __name__ == "__main__":
+    test_reduce_mask()
+    test_band_pixels_match_full_search()
+    test_window_bases()
+    print("reduce_mask and band_pixels match brute force, window bases are "
+          "fixed unless seeded")
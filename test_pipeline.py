@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+import tempfile
+import cv2
+import matplotlib.image as mpimg
+import numpy as np
+import camera_registry
+import pipeline
+
+
+def test_process_batch_matches_process_image():
+    frames = np.array([mpimg.imread(fname)
+                       for fname in sorted(glob.glob('video_images/*.jpg'))])
+    for warp_first in (False, True):
+        ll = pipeline.new_lane_lines(warp_first)
+        expected = [pipeline.process_image(frame, lane_lines=ll,
+                                           warp_first=warp_first)
+                    for frame in frames]
+        batch_ll = pipeline.new_lane_lines(warp_first)
+        annotated = pipeline.process_batch(frames, lane_lines=batch_ll,
+                                           warp_first=warp_first, workers=2)
+        assert all(np.array_equal(a, b)
+                   for a, b in zip(annotated, expected))
+        assert np.array_equal(batch_ll.left_fit, ll.left_fit)
+
+
+def test_cropped_transform_matches_full_frame():
+    c, t, _ = pipeline.camera_for()
+    for fname in sorted(glob.glob('test_images/*.jpg')):
+        undistorted = c.undistort(mpimg.imread(fname))
+        binary = pipeline.LaneThreshold().apply(undistorted)
+        x0, y0, x1, y1 = t.source_box(undistorted.shape)
+        for image in (undistorted, binary):
+            assert np.array_equal(
+                t.transform_cropped(image[y0:y1, x0:x1], undistorted.shape),
+                t.transform(image))
+        # nothing outside the box reaches the birds' eye view
+        masked = undistorted.copy()
+        masked[:y0] = masked[y1:] = 255
+        masked[:, :x0] = masked[:, x1:] = 255
+        assert np.array_equal(t.transform(masked), t.transform(undistorted))
+
+
+def write_clip(path, frames, fps=10):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                             (frames[0].shape[1], frames[0].shape[0]))
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    writer.release()
+
+
+def test_parallel_workers_share_the_loaded_camera():
+    frames = [mpimg.imread(fname)
+              for fname in sorted(glob.glob('video_images/project*.jpg'))]
+    parent = os.getpid()
+    calibration_class = camera_registry.CameraCalibration
+
+    class ParentOnlyCalibration(calibration_class):
+        def __init__(self, *args, **kwargs):
+            assert os.getpid() == parent, "A worker loaded the calibration"
+            super().__init__(*args, **kwargs)
+
+    # a camera no process has loaded yet
+    pipeline.cameras.register('parallel', 'camera_cal/calibration*.jpg',
+                              'test_images/straight_lines*jpg')
+    camera_registry.CameraCalibration = ParentOnlyCalibration
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            write_clip(os.path.join(tmp, 'clip.mp4'), frames)
+            pipeline.annotate_video_parallel(
+                os.path.join(tmp, 'clip.mp4'),
+                os.path.join(tmp, 'annotated.mp4'), workers=2,
+                chunk_frames=4, camera='parallel')
+            assert os.path.getsize(os.path.join(tmp, 'annotated.mp4')) > 0
+    finally:
+        camera_registry.CameraCalibration = calibration_class
+    assert pipeline.cameras.loaded('parallel')
+
+
+if __name__ == "__main__":
+    test_process_batch_matches_process_image()
+    test_cropped_transform_matches_full_frame()
+    test_parallel_workers_share_the_loaded_camera()
+    print("process_batch matches process_image frame by frame, cropped "
+          "transforms match full frame ones, and parallel workers share the "
+          "loaded camera")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from processing_helpers import *
+import cv2
+import numpy as np
+import matplotlib.image as mpimg
+
+
+def baseline_overlay(image, polygons, alpha=0.3, shift=0):
+    """
+      The full frame overlay that overlay_polygons replaces.
+    """
+    overlay = np.zeros_like(image)
+    for points, color in polygons:
+        cv2.fillPoly(overlay, [np.int32(points)], color, shift=shift)
+    return cv2.addWeighted(image, 1, overlay, alpha, 0)
+
+
+def test_overlay_polygons_matches_full_frame_overlay():
+    frame = mpimg.imread('test_images/test1.jpg')
+    # a lane and its two lines, drawn over it, and a polygon partly off frame
+    polygons = [([[300, 700], [560, 470], [730, 470], [1100, 700]],
+                 (0, 255, 0)),
+                ([[290, 700], [550, 470], [570, 470], [320, 700]],
+                 (255, 0, 0)),
+                ([[1080, 700], [720, 470], [740, 470], [1110, 700]],
+                 (0, 0, 255)),
+                ([[1200, 600], [1400, 650], [1250, 800]], (255, 255, 0))]
+    expected = baseline_overlay(frame, polygons)
+    assert np.array_equal(overlay_polygons(frame.copy(), polygons), expected)
+    scratch = np.empty_like(frame)
+    scratch.fill(7)
+    assert np.array_equal(overlay_polygons(frame.copy(), polygons,
+                                           scratch=scratch), expected)
+    # float vertices are rasterized with shift fractional bits
+    fractional = [(np.array(points) + 0.3125, color)
+                  for points, color in polygons]
+    fixed = [(np.array(points) * 16, color) for points, color in fractional]
+    assert np.array_equal(overlay_polygons(frame.copy(), fractional),
+                          baseline_overlay(frame, fixed, shift=4))
+    # polygons entirely off frame leave it untouched
+    assert np.array_equal(overlay_polygons(
+        frame.copy(), [([[-50, -50], [-10, -50], [-10, -10]], (0, 255, 0))]),
+        frame)
+
+
+if __name__ == "__main__":
+    test_overlay_polygons_matches_full_frame_overlay()
+    print("overlay_polygons matches a full frame fillPoly and addWeighted")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+from scheduler import *
+
+
+def test_scheduler_degrades_and_recovers():
+    s = AdaptiveScheduler(deadline=0.04, levels=3, smoothing=0.5,
+                          patience=5)
+    s.record(0.02)
+    assert s.level == 0
+    # a late frame moves one level down, and the cheapest level is kept
+    s.record(0.1)
+    assert s.level == 1
+    s.record(0.05)
+    assert s.level == 2
+    s.record(0.05)
+    assert s.level == 2
+    # after patience comfortable frames the next level up is tried again,
+    # from an estimate of headroom * deadline
+    s.record(0.01)
+    s.record(0.01)
+    s.record(0.01)
+    s.record(0.01)
+    assert s.level == 2
+    s.record(0.01)
+    assert s.level == 1
+    # and abandoned as soon as it runs late
+    s.record(0.06)
+    assert s.level == 2
+    assert s.report() == {'frames': 10, 'degraded_frames': 8,
+                          'level_counts': [2, 2, 6]}
+
+
+def test_scheduler_ignores_unrepresentative_frames():
+    s = AdaptiveScheduler(deadline=0.04, levels=2)
+    s.record(None)
+    assert s.level == 0 and s.frames == 1
+    s.record(0.01)
+    s.record(None)
+    assert s.level == 0 and s.frames == 3
+    try:
+        AdaptiveScheduler(deadline=0.04, levels=0)
+        assert False
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    test_scheduler_degrades_and_recovers()
+    test_scheduler_ignores_unrepresentative_frames()
+    print("AdaptiveScheduler degrades on late frames and recovers")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+from server import *
+import asyncio
+import glob
+import threading
+import matplotlib.image as mpimg
+import numpy as np
+import pipeline
+
+
+def serving(**server_args):
+    # a LaneServer on a localhost port, on an event loop of its own thread
+    loop = asyncio.new_event_loop()
+    server = LaneServer(**server_args)
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start(port=0))
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    return server, stop
+
+
+def test_server_tracks_streams():
+    frames = [mpimg.imread(fname)
+              for fname in sorted(glob.glob('video_images/*.jpg'))[:4]]
+    server, stop = serving(workers=2)
+    try:
+        client = LaneClient(*server.address)
+        ll = pipeline.new_lane_lines()
+        for i, frame in enumerate(frames):
+            fmt = ('npy', 'raw')[i % 2]
+            result = client.frame('front', frame, annotate=(i == 0), fmt=fmt)
+            left_fit, right_fit, curvature, displacement = \
+                pipeline.detect_lanes(frame, ll)
+            assert result['frame'] == i
+            assert np.allclose(result['left_fit'], left_fit)
+            assert np.isclose(result['displacement'], displacement)
+        assert result['stream'] == 'front'
+        # a jpeg encoded frame starts a stream of its own
+        result = client.frame('rear', frames[0], fmt='jpg')
+        assert result['frame'] == 0 and result['lanes_found']
+        assert client.reset('front')['frames'] == len(frames)
+        metrics = client.metrics()
+        assert metrics['completed'] == len(frames) + 1
+        assert metrics['streams'] == 1
+        try:
+            client.request('GET', '/nowhere')
+            assert False
+        except HTTPError as e:
+            assert e.status == 404
+        client.close()
+    finally:
+        stop()
+
+
+if __name__ == "__main__":
+    test_server_tracks_streams()
+    print("LaneServer tracks streams over HTTP")
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+from sweep import *
+import glob
+import matplotlib.image as mpimg
+import numpy as np
+import pipeline
+
+
+def test_chunks_keep_threshold_groups_together():
+    parameter_sets = combinations({'s_thresh': [[150, 255], [170, 255],
+                                                [190, 255]],
+                                   'margin': [12, 16, 20, 24]})
+    for workers in (2, 3):
+        bounds = chunk_bounds(parameter_sets, workers)
+        assert bounds[0] == 0 and bounds[-1] == len(parameter_sets)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            # no threshold group is split between chunks
+            assert start < stop
+            assert (start == 0 or threshold_key(parameter_sets[start]) !=
+                    threshold_key(parameter_sets[start - 1]))
+    # with fewer groups than workers, every worker still gets combinations
+    assert chunk_bounds(parameter_sets, 6) == [0, 2, 4, 6, 8, 10, 12]
+
+
+def test_defaults_match_detect_lanes():
+    frames = np.array([mpimg.imread(fname) for fname in
+                       sorted(glob.glob('video_images/project*.jpg'))[:4]])
+    row, = sweep(frames, {}, workers=1)
+    ll = pipeline.new_lane_lines()
+    detections = [pipeline.detect_lanes(frame, ll) for frame in frames]
+    assert row['frames'] == len(frames)
+    assert np.isclose(row['median_curvature_m'],
+                      np.median([d[2] for d in detections]))
+    assert np.isclose(row['mean_displacement_m'],
+                      np.mean([d[3] for d in detections]))
+
+
+if __name__ == "__main__":
+    test_chunks_keep_threshold_groups_together()
+    test_defaults_match_detect_lanes()
+    print("Sweep chunks keep threshold groups together, and its defaults "
+          "match detect_lanes")